@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+'''Audio-similarity edges from codeword histograms.
+
+Histograms (as produced by encode_msd.py and merge_encodings.py) are
+memory-mapped and streamed in chunks through one MiniBatchKMeans per cluster
+count, so the full collection never needs to fit in memory.
+'''
+
+import argparse
+import sys
+
+import numpy as np
+import scipy.sparse
+import sklearn.cluster
+
+from VectorQuantizer import VectorQuantizer
+from merge_encodings import track_file
+from build_hypergraph import save_csr
+
+
+def process_arguments(args):
+    '''Process arguments from the command line'''
+
+    parser = argparse.ArgumentParser(description='Streaming audio edge '
+                                     'builder')
+
+    parser.add_argument('-k', '--clusters', dest='n_clusters', type=int,
+                        nargs='+', default=[16, 64, 256],
+                        help='Number of clusters (one edge family per value)')
+
+    parser.add_argument('-q', '--quantizers', dest='n_quantizers', type=int,
+                        default=1,
+                        help='Number of clusters each track belongs to')
+
+    parser.add_argument('--soft', dest='soft', default=False,
+                        action='store_true',
+                        help='Weight memberships by inverse distance')
+
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int,
+                        default=10000,
+                        help='Number of histograms per chunk')
+
+    parser.add_argument('-p', '--passes', dest='n_passes', type=int,
+                        default=1, help='Number of passes over the data')
+
+    parser.add_argument('-r', '--random-state', dest='random_state',
+                        type=int, default=None, help='Random seed')
+
+    parser.add_argument('histograms', type=str,
+                        help='Codeword histograms (.npy, from '
+                        'merge_encodings.py)')
+
+    parser.add_argument('output', type=str,
+                        help='Path to store the audio edges (.npz)')
+
+    return vars(parser.parse_args(args))
+
+
+def chunks(n, batch_size):
+    '''Chunk boundaries for n items.
+
+    A short final chunk is merged into its predecessor, so every chunk
+    has at least batch_size items (when n >= batch_size).
+    '''
+
+    starts = list(range(0, n, batch_size))
+
+    if len(starts) > 1 and n - starts[-1] < batch_size:
+        starts.pop()
+
+    return list(zip(starts, starts[1:] + [n]))
+
+
+def fit_quantizers(X, n_clusters, n_quantizers=1, batch_size=10000,
+                   n_passes=1, random_state=None):
+    '''Fit one vector quantizer per cluster count in a single sweep.
+
+    :parameters:
+        - X : ndarray or memmap, shape=(n_tracks, n_codewords)
+            Codeword histograms
+
+        - n_clusters : list of int
+            Number of clusters for each quantizer
+
+        - n_quantizers : int > 0
+            Number of clusters each track is assigned to
+
+        - batch_size : int
+            Number of histograms to process at once.
+            Must be at least max(n_clusters).
+
+        - n_passes : int > 0
+            Number of passes over X
+
+    :returns:
+        - quantizers : list of VectorQuantizer
+    '''
+
+    if batch_size < max(n_clusters):
+        raise ValueError('batch_size={:d} must be at least '
+                         'max(n_clusters)={:d}'.format(batch_size,
+                                                       max(n_clusters)))
+
+    rng = np.random.RandomState(random_state)
+
+    quantizers = [VectorQuantizer(clusterer=sklearn.cluster.MiniBatchKMeans(n_clusters=k,
+                                                                             random_state=rng),
+                                  n_quantizers=n_quantizers,
+                                  batch_size=batch_size)
+                  for k in n_clusters]
+
+    bounds = chunks(X.shape[0], batch_size)
+
+    for epoch in range(n_passes):
+        print 'Pass {:d}'.format(epoch)
+
+        for i in rng.permutation(len(bounds)):
+            start, end = bounds[i]
+
+            # Fit in hellinger space
+            X_chunk = np.sqrt(X[start:end])
+
+            for vq in quantizers:
+                vq.partial_fit(X_chunk)
+
+    return quantizers
+
+
+def memberships(X, vq, soft=False):
+    '''Compute the top-k cluster memberships for a block of data.
+
+    :returns:
+        - hits : ndarray, shape=(n, n_quantizers)
+            Cluster index of each membership
+
+        - weights : ndarray, shape=(n, n_quantizers)
+            Membership weights: 1 for hard assignment, or normalized
+            inverse distance if soft=True
+    '''
+
+    # Half squared distance to each center, up to a per-row constant
+    XC = - np.dot(X, vq.components_.T) + vq.center_norms_
+
+    k = vq.n_quantizers
+    hits = np.argpartition(XC, k - 1, axis=1)[:, :k]
+
+    if not soft:
+        return hits, np.ones(hits.shape, dtype=np.float32)
+
+    rows = np.arange(len(X))[:, np.newaxis]
+    dist = 2 * XC[rows, hits] + (X**2).sum(axis=1, keepdims=True)
+
+    weights = 1.0 / np.sqrt(np.maximum(dist, 1e-8))
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    return hits, weights.astype(np.float32)
+
+
+def edge_incidence(X, quantizers, batch_size=10000, soft=False):
+    '''Build the track-edge incidence matrix from fitted quantizers.
+
+    :returns:
+        - H : scipy.sparse.csr_matrix, shape=(n_tracks, sum(n_clusters))
+        - edges : ndarray of edge names
+    '''
+
+    n_tracks = X.shape[0]
+
+    offsets = np.cumsum([0] + [vq.components_.shape[0] for vq in quantizers])
+
+    rows, cols, data = [], [], []
+
+    for start, end in chunks(n_tracks, batch_size):
+        X_chunk = np.sqrt(X[start:end])
+
+        for offset, vq in zip(offsets, quantizers):
+            hits, weights = memberships(X_chunk, vq, soft=soft)
+
+            rows.append(np.repeat(np.arange(start, end), hits.shape[1]))
+            cols.append(offset + hits.ravel())
+            data.append(weights.ravel())
+
+    H = scipy.sparse.csr_matrix((np.concatenate(data),
+                                 (np.concatenate(rows), np.concatenate(cols))),
+                                shape=(n_tracks, offsets[-1]))
+
+    edges = np.asarray([u'[AUDIO] {:d}/{:d}'.format(n, vq.components_.shape[0])
+                        for vq in quantizers
+                        for n in range(vq.components_.shape[0])])
+
+    return H, edges
+
+
+def build_audio_edges(histograms='', output='', n_clusters=None,
+                      n_quantizers=1, soft=False, batch_size=10000,
+                      n_passes=1, random_state=None):
+    '''Cluster the histograms and save the audio edges'''
+
+    X = np.load(histograms, mmap_mode='r')
+    tracks = np.load(track_file(histograms))
+
+    print 'Clustering {:d} histograms'.format(X.shape[0])
+    quantizers = fit_quantizers(X, n_clusters or [16, 64, 256],
+                                n_quantizers=n_quantizers,
+                                batch_size=batch_size,
+                                n_passes=n_passes,
+                                random_state=random_state)
+
+    print 'Building edges'
+    H, edges = edge_incidence(X, quantizers, batch_size=batch_size, soft=soft)
+
+    print 'Saving to {:s}'.format(output)
+    save_csr(output, H, tracks=tracks, edges=edges)
+
+
+if __name__ == '__main__':
+    build_audio_edges(**process_arguments(sys.argv[1:]))
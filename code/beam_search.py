@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+'''Beam-search playlist continuation.
+
+Transitions follow the model's likelihood (as in training and
+`evaluate.transition_probs`): from the current song s, an edge e is chosen
+with probability g_s[e] = softmax_e(H[s, e] w_e) over all edges, and the next
+song t is chosen within e with probability proportional to
+x_u[t] = exp(b_t + U_u . V_t).  Marginalizing over edges:
+
+    Pr(t | s, u) = x_u[t] sum_e H[t, e] g_s[e] / N_u[e]
+
+where N_u = H' x_u are per-user edge norms.  An empty seed starts from
+g[e] = softmax(w).
+
+Edges not containing s all have the same logit (0), so g_s splits into a
+constant over all edges plus a correction on the edges of s:
+
+    g_s[e] = (a_s + psi_s[e]) / Z_s
+
+The constant term gives x_u * (H / N_u), a dense vector computed (and
+sorted) once per seed; the correction is a sparse product over the edges of
+the current songs.  Edges containing every song (such as the uniform edge)
+would put the whole catalog in every correction, so their fixed term is
+instead kept as a second sorted dense vector, x_u.  Songs outside the
+correction's support are ranked by the dense terms alone, so each beam row
+only scores its sparse neighbourhood plus the heads of its seed's sorted dense
+terms.  The beam for every seed playlist is stored in flat arrays, and the
+cost of a step scales with the beam width times the sparse neighbourhood of
+the beam, rather than with the size of the catalog.
+'''
+
+import argparse
+import sys
+
+import cPickle as pickle
+import numpy as np
+import scipy.sparse
+import ujson as json
+
+import evaluate
+import shyrp
+from song_index import SongIndex
+
+
+def process_arguments(args):
+    '''Process arguments from the command line'''
+
+    parser = argparse.ArgumentParser(description='SHYRP beam-search decoder')
+
+    parser.add_argument('-n', '--num-songs', dest='n_songs', type=int,
+                        default=20, help='Number of songs to add')
+    parser.add_argument('-B', '--beam-width', dest='beam_width', type=int,
+                        default=10, help='Beam width')
+    parser.add_argument('model', type=str,
+                        help='Trained model pickle (from train_model.py)')
+    parser.add_argument('seeds', type=str,
+                        help='JSON list of {"user": ..., "playlist": [song ids]}')
+    parser.add_argument('output', type=str,
+                        help='Path to store the continuations (JSON)')
+
+    return vars(parser.parse_args(args))
+
+
+def row_ids(X):
+    '''Row index of each stored entry of a CSR matrix'''
+
+    return np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+
+
+def contains(sorted_keys, keys):
+    '''Which of `keys` appear in the sorted array `sorted_keys`'''
+
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+
+    pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+
+    return sorted_keys[pos] == keys
+
+
+def edge_transitions(H, w):
+    '''Edge selection probabilities under the model's likelihood.
+
+    For each source (every song, plus a final row for the start of a
+    playlist), the edge distribution softmax_e(F[s, e] w_e) is split as
+    (a_s + psi_s[e]) / Z_s, where psi_s is supported on the edges of s.
+    Logits are shifted per source, so nothing overflows.
+
+    :parameters:
+        - H : scipy.sparse.csr_matrix, shape=(n_songs, n_edges)
+        - w : np.ndarray, shape=(n_edges,)
+
+    :returns:
+        - psi : scipy.sparse.csr_matrix, shape=(n_songs + 1, n_edges)
+        - a : np.ndarray, shape=(n_songs + 1,)
+        - Z : np.ndarray, shape=(n_songs + 1,)
+    '''
+
+    n_edges = H.shape[1]
+
+    psi = scipy.sparse.vstack([H, np.ones((1, n_edges))]).tocsr()
+    psi.data = psi.data.astype(np.float64) * w[psi.indices]
+
+    rows = row_ids(psi)
+    shift = np.zeros(psi.shape[0])
+    np.maximum.at(shift, rows, psi.data)
+
+    a = np.exp(-shift)
+    psi.data = np.exp(psi.data - shift[rows]) - a[rows]
+
+    Z = a * n_edges + psi.sum(axis=1).A1
+
+    return psi, a, Z
+
+
+def beam_search(model, seeds, users=None, n_songs=20, beam_width=10):
+    '''Find high-probability continuations of a batch of playlists.
+
+    :parameters:
+        - model : shyrp.PlaylistModel or dict (serialized model)
+
+        - seeds : list of list of int
+            Seed playlists, as song indices.  Seeds may be empty.
+
+        - users : list or None
+            User key for each seed.  Users not known to the model (or None)
+            are scored with all-zero factors.
+
+        - n_songs : int > 0
+            Number of songs to add to each seed
+
+        - beam_width : int > 0
+            Number of partial continuations to keep for each seed
+
+    :returns:
+        - continuations : list of np.ndarray
+            The best continuation found for each seed.  Songs in the seed
+            are never repeated, so a continuation can be shorter than
+            `n_songs` if the catalog is exhausted.
+
+        - scores : np.ndarray
+            Log-probability of each continuation given its seed
+    '''
+
+    arrays = evaluate.model_arrays(model)
+
+    H = arrays['H']
+    n_total = H.shape[0]
+    n_seeds = len(seeds)
+
+    if users is None:
+        users = [None] * n_seeds
+
+    default_user = len(arrays['U']) - 1
+    u_i = np.asarray([arrays['user_map'].get(_, default_user) for _ in users])
+
+    # Song scores and edge norms for each seed, computed once
+    scores = np.dot(arrays['U'][u_i], arrays['V'].T) + arrays['b']
+    scores -= scores.max(axis=1, keepdims=True)
+    x = np.exp(scores)
+    inv_norms = 1.0 / (shyrp._EPS + H.T.dot(x.T).T)
+
+    # Edges holding every song with unit weight (eg, the uniform edge) are in
+    # the correction of every song, but their term is fixed per source: it
+    # is folded into a second dense term, proportional to x.
+    unit = H.copy()
+    unit.data = (unit.data == 1).astype(np.float64)
+    full = unit.sum(axis=0).A1 == n_total
+
+    # Source rows: one per song, plus a final row for empty seeds
+    psi, a, Z = edge_transitions(H, arrays['w'])
+    psi_full = psi[:, full].toarray()
+    psi = psi[:, ~full].tocsr()
+
+    inv_full = inv_norms[:, full]
+    inv_norms = inv_norms[:, ~full]
+    H = H[:, ~full]
+
+    # The constant term of each seed's transitions over the remaining edges,
+    # x * H (1 / N), and the songs of both dense terms in decreasing order
+    base = x * H.dot(inv_norms.T).T
+    base_order = np.argsort(-base, axis=1)
+    x_order = np.argsort(-x, axis=1)
+
+    targets = H.T.tocsr()
+
+    # Seed songs, padded with -1, for exclusion
+    seed_lengths = np.asarray([len(_) for _ in seeds])
+    seed_songs = -np.ones((n_seeds, seed_lengths.max()), dtype=int)
+    for k, seed in enumerate(seeds):
+        seed_songs[k, :len(seed)] = seed
+
+    # Beam state: seed index, log-probability and generated songs per row
+    beam_seed = np.arange(n_seeds)
+    beam_score = np.zeros(n_seeds)
+    beam_songs = np.zeros((n_seeds, 0), dtype=int)
+    beam_last = np.asarray([s[-1] if len(s) else n_total for s in seeds])
+
+    best_songs = [np.zeros(0, dtype=int) for _ in seeds]
+    best_score = np.zeros(n_seeds)
+
+    for step in range(n_songs):
+        n_beam = len(beam_last)
+        beam_rows = np.arange(n_beam)[:, np.newaxis]
+
+        # Weights of the dense terms for each row
+        w_base = a[beam_last]
+        w_x = ((w_base[:, np.newaxis] + psi_full[beam_last])
+               * inv_full[beam_seed]).sum(axis=1)
+
+        # Correction on the edges of the current songs
+        A = psi[beam_last]
+        A.data *= inv_norms[beam_seed[row_ids(A)], A.indices]
+        C = A.dot(targets).tocsr()
+        C.sort_indices()
+
+        # Candidates are keyed by (beam row, song); C's keys are sorted
+        c_keys = row_ids(C) * n_total + C.indices
+        c_value = C.data * x[beam_seed[row_ids(C)], C.indices]
+
+        # Songs already in the seed or in the beam's history
+        excluded = np.concatenate([seed_songs[beam_seed], beam_songs], axis=1)
+        excluded = np.sort((beam_rows * n_total + excluded)[excluded >= 0])
+
+        # Off the correction's support, a song scores no more than the last
+        # of the n_head best songs of both dense terms.  The head grows until
+        # every row has beam_width candidates above that bound, so no other
+        # song can enter the beam.
+        n_head = min(n_total, beam_width + step + seed_lengths.max())
+
+        while True:
+            h_keys = np.unique(np.hstack([
+                beam_rows * n_total + base_order[beam_seed, :n_head],
+                beam_rows * n_total + x_order[beam_seed, :n_head]]))
+            h_keys = h_keys[~contains(c_keys, h_keys)]
+
+            keys = np.concatenate([c_keys, h_keys])
+            value = np.concatenate([c_value, np.zeros(len(h_keys))])
+
+            keep = ~contains(excluded, keys)
+            keys, value = keys[keep], value[keep]
+            rows, cols = keys // n_total, keys % n_total
+            cand_seed = beam_seed[rows]
+
+            value += (w_base[rows] * base[cand_seed, cols]
+                      + w_x[rows] * x[cand_seed, cols])
+
+            if n_head == n_total:
+                break
+
+            bound = (w_base * base[beam_seed, base_order[beam_seed, n_head - 1]]
+                     + w_x * x[beam_seed, x_order[beam_seed, n_head - 1]])
+            n_above = np.bincount(rows[value >= bound[rows]], minlength=n_beam)
+
+            if (n_above >= beam_width).all():
+                break
+
+            n_head = min(n_total, 2 * n_head)
+
+        # Next-song probabilities of the candidates
+        prob = value / Z[beam_last[rows]]
+
+        keep = prob > 0
+
+        if not keep.any():
+            break
+
+        rows, cols, cand_seed = rows[keep], cols[keep], cand_seed[keep]
+        cand_score = beam_score[rows] + np.log(prob[keep])
+
+        # Top beam_width candidates for each seed
+        order = np.argsort(-cand_score)
+        order = order[np.argsort(cand_seed[order], kind='mergesort')]
+        cand_seed = cand_seed[order]
+        rank = np.arange(len(order)) - np.searchsorted(cand_seed, cand_seed)
+        order = order[rank < beam_width]
+
+        beam_seed = cand_seed[rank < beam_width]
+        beam_score = cand_score[order]
+        beam_songs = np.hstack([beam_songs[rows[order]],
+                                cols[order, np.newaxis]])
+        beam_last = cols[order]
+
+        # The head of each seed's group is its best continuation so far
+        heads = np.flatnonzero(rank[rank < beam_width] == 0)
+        for i in heads:
+            best_songs[beam_seed[i]] = beam_songs[i]
+            best_score[beam_seed[i]] = beam_score[i]
+
+    return best_songs, best_score
+
+
+def run_beam_search(model='', seeds='', output='', **kwargs):
+
+    print 'Loading model'
+    with open(model, 'r') as fdesc:
+        data = pickle.load(fdesc)
+
+    songs = SongIndex(data['song_ids'])
+
+    with open(seeds, 'r') as fdesc:
+        requests = json.load(fdesc)
+
+    print 'Decoding {:d} playlists'.format(len(requests))
+    continuations, scores = beam_search(data['model'],
+                                        [songs.rows(r.get('playlist', []))
+                                         for r in requests],
+                                        users=[r.get('user') for r in requests],
+                                        **kwargs)
+
+    results = [dict(playlist=songs[c].tolist(), score=s)
+               for c, s in zip(continuations, scores.tolist())]
+
+    print 'Saving to {:s}'.format(output)
+    with open(output, 'w') as fdesc:
+        json.dump(results, fdesc)
+
+
+if __name__ == '__main__':
+    run_beam_search(**process_arguments(sys.argv[1:]))
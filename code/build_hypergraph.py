@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+'''Hypergraph construction pipeline.
+
+Each edge family (uniform, tags, era, ...) is built directly into a CSR
+incidence matrix over a shared, sorted song index.  Every intermediate
+artifact is cached on disk under a key derived from a hash of its inputs,
+parameters and the source of this module, so only the families whose inputs
+changed are rebuilt, and a change to any builder invalidates the cache.
+'''
+
+import argparse
+import hashlib
+import inspect
+import os
+import sys
+
+import numpy as np
+import scipy.sparse
+import pandas as pd
+
+import song_index
+
+
+def process_arguments(args):
+    '''Process arguments from the command line'''
+
+    parser = argparse.ArgumentParser(description='Hypergraph edge builder')
+
+    parser.add_argument('-o', '--output', dest='output', required=True,
+                        type=str, help='Path to store the hypergraph (.npz)')
+
+    parser.add_argument('-c', '--cache', dest='cache_dir', type=str,
+                        default='hypergraph_cache',
+                        help='Directory for cached build artifacts')
+
+    parser.add_argument('-t', '--tags', dest='tag_file', type=str,
+                        default=None, help='Song tag data (json)')
+
+    parser.add_argument('--tag-column', dest='tag_column', type=str,
+                        default='tag', help='Tag column to build edges from')
+
+    parser.add_argument('-y', '--metadata', dest='meta_file', type=str,
+                        default=None, help='Song metadata (json) for era edges')
+
+    parser.add_argument('--era', dest='era', nargs='+',
+                        choices=['year', 'decade'], default=['year', 'decade'],
+                        help='Which era edge families to build')
+
+    parser.add_argument('-a', '--audio', dest='audio_file', type=str,
+                        default=None,
+                        help='Audio edges (.npz, from audio_edges.py)')
+
+    parser.add_argument('-m', '--min-size', dest='min_size', type=int,
+                        default=0, help='Minimum number of songs per edge')
+
+    parser.add_argument('playlists', type=str,
+                        help='Playlist segment data (json)')
+
+    parser.add_argument('valid_songs', type=str,
+                        help='Valid song data (json)')
+
+    return vars(parser.parse_args(args))
+
+
+def file_digest(filename, block_size=2**20):
+    '''Hash the contents of a file'''
+
+    digest = hashlib.sha1()
+
+    with open(filename, 'rb') as fdesc:
+        for block in iter(lambda: fdesc.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def cache_key(*parts):
+    '''Hash a sequence of parameters into a cache key'''
+
+    return hashlib.sha1('\0'.join([repr(_) for _ in parts])).hexdigest()
+
+
+def save_csr(filename, H, **kwargs):
+    '''Save a sparse matrix and any auxiliary arrays to an npz file.
+
+    The file is written to a temporary location first, so an interrupted
+    build never leaves a corrupted artifact in place.
+    '''
+
+    H = H.tocsr()
+
+    tmp_name = '{:s}.tmp'.format(filename)
+
+    with open(tmp_name, 'wb') as fdesc:
+        np.savez(fdesc,
+                 data=H.data,
+                 indices=H.indices,
+                 indptr=H.indptr,
+                 shape=np.asarray(H.shape),
+                 **kwargs)
+
+    os.rename(tmp_name, filename)
+
+
+def load_csr(filename):
+    '''Load a sparse matrix and auxiliary arrays saved by `save_csr`'''
+
+    with np.load(filename) as data:
+        H = scipy.sparse.csr_matrix((data['data'],
+                                     data['indices'],
+                                     data['indptr']),
+                                    shape=tuple(data['shape']))
+
+        extra = dict([(key, data[key]) for key in data.files
+                      if key not in ('data', 'indices', 'indptr', 'shape')])
+
+    return H, extra
+
+
+def load_graph(filename):
+    '''Load a hypergraph built by this module.
+
+    :returns:
+        - H : scipy.sparse.csr_matrix, shape=(n_songs, n_edges)
+        - songs : ndarray, shape=(n_songs,)
+            Song ids, in row order
+        - edges : ndarray, shape=(n_edges,)
+            Edge names, in column order
+    '''
+
+    H, extra = load_csr(filename)
+
+    return H.astype(np.float32), extra['songs'], extra['edges']
+
+
+def incidence(rows, cols, n_songs, n_edges):
+    '''Build a binary CSR incidence matrix from (row, column) pairs'''
+
+    H = scipy.sparse.coo_matrix((np.ones(len(rows), dtype=np.float32),
+                                 (rows, cols)),
+                                shape=(n_songs, n_edges)).tocsr()
+
+    # Collapse duplicate memberships
+    H.data[:] = 1.0
+
+    return H
+
+
+def song_rows(songs, song_ids):
+    '''Vectorized lookup of song ids in the sorted song index.
+
+    :returns:
+        - rows : ndarray of int
+            row number for each id in song_ids that appears in songs
+        - mask : ndarray of bool
+            which elements of song_ids were found
+    '''
+
+    rows = song_index.SongIndex(songs).rows(song_ids, missing=-1)
+    mask = rows >= 0
+
+    return rows[mask], mask
+
+
+def make_song_index(playlist_file, valid_songs_file):
+    '''Construct the shared song index.
+
+    :returns:
+        - songs : ndarray
+            Sorted ids of valid songs which appear in at least one playlist
+        - track_ids : ndarray
+            MSD track id for each song
+    '''
+
+    pl_data = pd.read_json(playlist_file)
+    valid_songs = pd.read_json(valid_songs_file, orient='index')
+
+    songs = np.intersect1d(valid_songs.index.values.astype(np.unicode_),
+                           pl_data['song_id'].unique().astype(np.unicode_))
+
+    track_ids = valid_songs.loc[songs, 'track_id'].values.astype(np.unicode_)
+
+    return songs, track_ids
+
+
+def make_uniform_edges(songs):
+    '''A single edge containing every song'''
+
+    H = scipy.sparse.csr_matrix(np.ones((len(songs), 1), dtype=np.float32))
+
+    return H, np.asarray([u'[UNIFORM]'])
+
+
+def make_tag_edges(tag_file, songs, target_column='tag'):
+    '''One edge per tag'''
+
+    tag_data = pd.read_json(tag_file)
+    tag_data = tag_data[tag_data['value'] > 0]
+
+    rows, mask = song_rows(songs, tag_data['song_id'].values.astype(np.unicode_))
+
+    tags, cols = np.unique(tag_data[target_column].values[mask],
+                           return_inverse=True)
+
+    edges = np.asarray([u'[TAG] "{:s}"'.format(x) for x in tags])
+
+    return incidence(rows, cols, len(songs), len(edges)), edges
+
+
+def make_era_edges(meta_file, songs, kind='year'):
+    '''One edge per year, or per overlapping decade window'''
+
+    meta_data = pd.read_json(meta_file)
+    meta_data = meta_data.dropna(subset=['year'])
+
+    rows, mask = song_rows(songs, meta_data['song_id'].values.astype(np.unicode_))
+    year = meta_data['year'].values[mask].astype(int)
+
+    if kind == 'year':
+        eras, cols = np.unique(year, return_inverse=True)
+        edges = np.asarray([u'[ERA] {:4d}'.format(x) for x in eras])
+
+    elif kind == 'decade':
+        # Each song belongs to its decade, and the decade offset by 5 years
+        rows = np.concatenate([rows, rows])
+        year = np.concatenate([year - np.mod(year, 10),
+                               year - np.mod(year - 5, 10)])
+
+        eras, cols = np.unique(year, return_inverse=True)
+        edges = np.asarray([u'[ERA] {:4d}--{:4d}'.format(x, x + 10)
+                            for x in eras])
+    else:
+        raise ValueError('Unknown era type: {:s}'.format(kind))
+
+    return incidence(rows, cols, len(songs), len(edges)), edges
+
+
+def make_audio_edges(audio_file, track_ids):
+    '''Align track-level audio edges to the song index'''
+
+    H_audio, extra = load_csr(audio_file)
+
+    order = np.argsort(extra['tracks'])
+    rows, mask = song_rows(extra['tracks'][order], track_ids)
+
+    # Select the audio row for each song that has one
+    select = incidence(np.flatnonzero(mask), order[rows],
+                       len(track_ids), H_audio.shape[0])
+
+    return (select * H_audio).tocsr(), extra['edges']
+
+
+def cached(cache_dir, name, key, builder, *args, **kwargs):
+    '''Load an artifact from the cache, or build and store it.
+
+    `builder` must return a (matrix, names) pair.
+    '''
+
+    filename = os.path.join(cache_dir, '{:s}-{:s}.npz'.format(name, key))
+
+    if os.path.exists(filename):
+        print 'Using cached {:s}'.format(name)
+        H, extra = load_csr(filename)
+        return H, extra['names']
+
+    print 'Building {:s}'.format(name)
+    H, names = builder(*args, **kwargs)
+    save_csr(filename, H, names=names)
+
+    return H, names
+
+
+def build_graph(playlists='', valid_songs='', output='',
+                cache_dir='hypergraph_cache', tag_file=None,
+                tag_column='tag', meta_file=None, era=None, audio_file=None,
+                min_size=0):
+    '''Build (or update) a hypergraph, reusing cached edge families'''
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # The song index depends only on the playlists and valid songs.
+    # Every family key is derived from it, so the source hash covers them all.
+    index_key = cache_key('songs', _SOURCE_HASH, file_digest(playlists),
+                          file_digest(valid_songs))
+
+    index_file = os.path.join(cache_dir, 'songs-{:s}.npz'.format(index_key))
+
+    if os.path.exists(index_file):
+        print 'Using cached song index'
+        with np.load(index_file) as data:
+            songs, track_ids = data['songs'], data['track_ids']
+    else:
+        print 'Building song index'
+        songs, track_ids = make_song_index(playlists, valid_songs)
+        with open('{:s}.tmp'.format(index_file), 'wb') as fdesc:
+            np.savez(fdesc, songs=songs, track_ids=track_ids)
+        os.rename('{:s}.tmp'.format(index_file), index_file)
+
+    # Build each edge family
+    families = [cached(cache_dir, 'uniform', cache_key(index_key),
+                       make_uniform_edges, songs)]
+
+    if tag_file is not None:
+        families.append(cached(cache_dir, 'tags',
+                               cache_key(index_key, file_digest(tag_file),
+                                         tag_column),
+                               make_tag_edges, tag_file, songs,
+                               target_column=tag_column))
+
+    if meta_file is not None:
+        meta_digest = file_digest(meta_file)
+
+        for kind in (era or []):
+            families.append(cached(cache_dir, 'era_{:s}'.format(kind),
+                                   cache_key(index_key, meta_digest, kind),
+                                   make_era_edges, meta_file, songs,
+                                   kind=kind))
+
+    if audio_file is not None:
+        families.append(cached(cache_dir, 'audio',
+                               cache_key(index_key, file_digest(audio_file)),
+                               make_audio_edges, audio_file, track_ids))
+
+    print 'Assembling the graph'
+    H = scipy.sparse.hstack([_[0] for _ in families], format='csc')
+    edges = np.concatenate([_[1] for _ in families])
+
+    keep = np.flatnonzero(np.diff(H.indptr) >= min_size)
+    H = H[:, keep]
+    edges = edges[keep]
+
+    print 'Saving {:d} songs x {:d} edges to {:s}'.format(H.shape[0],
+                                                        H.shape[1],
+                                                        output)
+    save_csr(output, H, songs=songs, edges=edges)
+    song_index.SongIndex(songs).save(song_index.index_file(output))
+    song_index.SongIndex(track_ids).save(song_index.track_file(output))
+
+
+# Cached artifacts are invalidated whenever this module changes
+_SOURCE_HASH = hashlib.sha1(inspect.getsource(sys.modules[__name__])).hexdigest()
+
+
+if __name__ == '__main__':
+    build_graph(**process_arguments(sys.argv[1:]))
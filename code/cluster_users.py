@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+'''User embedding and clustering.
+
+Users are represented either by their learned factors (`U` from a trained
+PlaylistModel), or by their empirical edge distributions: for each user, the
+normalized count of edges shared by the two songs of each of their bigrams.
+Edge distributions are kept sparse, and mapped through the square root
+(Hellinger embedding) so that Euclidean distance is meaningful.
+
+Representations are reduced with randomized truncated SVD, embedded in two
+dimensions with Barnes-Hut t-SNE, and clustered in chunks with mini-batch
+k-means.  Results are saved as an npz file of user ids, 2-d embedding,
+reduced features and cluster labels.
+'''
+
+import argparse
+import sys
+
+import cPickle as pickle
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.manifold import TSNE
+
+import shyrp
+import train_model
+
+
+def process_arguments(args):
+    '''Process arguments from the command line'''
+
+    parser = argparse.ArgumentParser(description='User embedding and clustering')
+
+    parser.add_argument('-e', '--edges', dest='edges', type=str, nargs='+',
+                        default=None,
+                        help='Edge files or hypergraph.  If provided, users '
+                        'are represented by edge distributions of their '
+                        'playlists; otherwise by learned user factors.')
+    parser.add_argument('-m', '--min-bigrams', dest='min_bigrams', type=int,
+                        default=5, help='Minimum number of bigrams per user')
+    parser.add_argument('-d', '--num-components', dest='n_components',
+                        type=int, default=50,
+                        help='Number of SVD components')
+    parser.add_argument('-k', '--num-clusters', dest='n_clusters', type=int,
+                        default=20, help='Number of clusters')
+    parser.add_argument('-p', '--perplexity', dest='perplexity', type=float,
+                        default=30.0, help='t-SNE perplexity')
+    parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int,
+                        default=4096,
+                        help='Number of users per clustering batch')
+    parser.add_argument('source', type=str,
+                        help='Trained model pickle (from train_model.py), or '
+                        'playlist dataframe pickle if --edges is given')
+    parser.add_argument('output', type=str,
+                        help='Path to store the results (npz)')
+
+    return vars(parser.parse_args(args))
+
+
+def user_factors(model):
+    '''Learned user factors of a model.
+
+    :parameters:
+        - model : shyrp.PlaylistModel or dict (serialized model)
+
+    :returns:
+        - user_ids : list
+        - U : np.ndarray, shape=(n_users, n_factors)
+    '''
+
+    if isinstance(model, dict):
+        user_map, U = model['user_map'], model['U']
+    else:
+        user_map, U = model.user_map_, model.U_
+
+    user_ids = sorted(user_map, key=user_map.get)
+
+    return user_ids, U[[user_map[_] for _ in user_ids]]
+
+
+def edge_distributions(playlists, H, min_bigrams=5, chunk_size=65536):
+    '''Empirical edge distribution of each user's bigrams.
+
+    For each bigram (s, t), every edge containing both s and t is counted
+    once.  Counts are normalized per user.
+
+    :parameters:
+        - playlists : dict (users => list of playlists)
+        - H : scipy.sparse matrix, shape=(n_songs, n_edges)
+
+        - min_bigrams : int
+            Users with fewer bigrams are dropped
+
+        - chunk_size : int > 0
+            Number of bigrams to process at once
+
+    :returns:
+        - user_ids : list
+        - P : scipy.sparse.csr_matrix, shape=(n_users, n_edges)
+    '''
+
+    H = H.tocsr()
+
+    user_ids = list(playlists)
+    user_map = dict([_[::-1] for _ in enumerate(user_ids)])
+
+    u_i, y_s, y_t = shyrp.make_theano_inputs(playlists, user_map)
+
+    # Skip the start-of-playlist pseudo-bigrams
+    bigram = y_s >= 0
+    u_i, y_s, y_t = u_i[bigram], y_s[bigram], y_t[bigram]
+
+    counts = scipy.sparse.csr_matrix((len(user_ids), H.shape[1]))
+
+    for i in range(0, len(u_i), chunk_size):
+        shared = H[y_s[i:i + chunk_size]].multiply(H[y_t[i:i + chunk_size]])
+        shared = (shared > 0).astype(np.float32)
+
+        users = u_i[i:i + chunk_size]
+        assign = scipy.sparse.csr_matrix((np.ones(len(users), dtype=np.float32),
+                                          (users, np.arange(len(users)))),
+                                         shape=(len(user_ids), len(users)))
+
+        counts = counts + assign.dot(shared)
+
+    n_bigrams = np.bincount(u_i, minlength=len(user_ids))
+    keep = np.flatnonzero((n_bigrams >= min_bigrams)
+                          & (counts.sum(axis=1).A1 > 0))
+
+    counts = counts[keep].tocsr()
+    counts.data /= np.repeat(counts.sum(axis=1).A1, np.diff(counts.indptr))
+
+    return [user_ids[_] for _ in keep], counts
+
+
+def reduce_dimension(X, n_components=50, random_state=None):
+    '''Randomized truncated SVD of a dense or sparse matrix.
+
+    If X already has at most `n_components` columns, it is returned as a
+    dense array.
+    '''
+
+    if X.shape[1] <= n_components:
+        if scipy.sparse.issparse(X):
+            X = X.toarray()
+        return np.asarray(X, dtype=np.float32)
+
+    svd = TruncatedSVD(n_components=n_components, algorithm='randomized',
+                       random_state=random_state)
+
+    return svd.fit_transform(X).astype(np.float32)
+
+
+def cluster(X, n_clusters=20, chunk_size=4096, n_passes=3, random_state=None):
+    '''Mini-batch k-means, fit and applied in chunks.
+
+    :returns:
+        - labels : np.ndarray, dtype=int32
+        - centers : np.ndarray, shape=(n_clusters, n_features)
+    '''
+
+    n_clusters = min(n_clusters, len(X))
+    chunk_size = max(chunk_size, n_clusters)
+
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state)
+
+    rng = np.random.RandomState(random_state)
+
+    for _ in range(n_passes):
+        order = rng.permutation(len(X))
+        for i in range(0, len(X), chunk_size):
+            batch = order[i:i + chunk_size]
+            if len(batch) >= n_clusters:
+                kmeans.partial_fit(X[batch])
+
+    labels = np.concatenate([kmeans.predict(X[i:i + chunk_size])
+                             for i in range(0, len(X), chunk_size)])
+
+    return labels.astype(np.int32), kmeans.cluster_centers_
+
+
+def cluster_users(X, hellinger=False, n_components=50, n_clusters=20,
+                  perplexity=30.0, chunk_size=4096, random_state=None):
+    '''Embed and cluster user representations.
+
+    :parameters:
+        - X : np.ndarray or scipy.sparse matrix, shape=(n_users, n_features)
+            User representations
+
+        - hellinger : bool
+            If true, X holds distributions, and is mapped through the
+            square root before reduction
+
+        - n_components : int > 0
+            Number of SVD components
+
+        - n_clusters : int > 0
+            Number of clusters
+
+        - perplexity : float > 0
+            t-SNE perplexity
+
+        - chunk_size : int > 0
+            Number of users per clustering batch
+
+    :returns:
+        - results : dict
+            - features : np.ndarray, reduced representations
+            - embedding : np.ndarray, shape=(n_users, 2)
+            - labels : np.ndarray, cluster assignments
+            - centers : np.ndarray, cluster centers in the reduced space
+    '''
+
+    if hellinger:
+        X = X.sqrt() if scipy.sparse.issparse(X) else np.sqrt(X)
+
+    features = reduce_dimension(X, n_components=n_components,
+                                random_state=random_state)
+
+    tsne = TSNE(n_components=2, perplexity=perplexity, method='barnes_hut',
+                init='pca', random_state=random_state)
+    embedding = tsne.fit_transform(features).astype(np.float32)
+
+    labels, centers = cluster(features, n_clusters=n_clusters,
+                              chunk_size=chunk_size,
+                              random_state=random_state)
+
+    return dict(features=features,
+                embedding=embedding,
+                labels=labels,
+                centers=centers.astype(np.float32))
+
+
+def run_clustering(source='', output='', edges=None, min_bigrams=5, **kwargs):
+
+    if edges is None:
+        print 'Loading model'
+        with open(source, 'r') as fdesc:
+            data = pickle.load(fdesc)
+
+        user_ids, X = user_factors(data['model'])
+        hellinger = False
+
+    else:
+        print 'Loading edges'
+        H, songs = train_model.load_graph(*edges)
+
+        print 'Loading playlists'
+        playlists = train_model.decompose(pd.read_pickle(source), songs)
+
+        print 'Computing edge distributions'
+        user_ids, X = edge_distributions(playlists, H, min_bigrams=min_bigrams)
+        hellinger = True
+
+    print 'Clustering {:d} users'.format(len(user_ids))
+    results = cluster_users(X, hellinger=hellinger, **kwargs)
+
+    print 'Saving to {:s}'.format(output)
+    np.savez(output, user_ids=np.asarray(user_ids), **results)
+
+
+if __name__ == '__main__':
+    run_clustering(**process_arguments(sys.argv[1:]))
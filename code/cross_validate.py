@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+'''Parallel k-fold cross-validation for SHYRP.
+
+The hypergraph is loaded once, and each fold's playlists are decomposed into
+flat bigram arrays once (and cached next to the fold pickles).  Folds are then
+trained concurrently in a process pool; forked workers share the read-only
+hypergraph and bigram arrays with the parent.
+
+Folds are split by user, so held-out users have no learned factors.  They
+are scored with an extra (all-zero) cold-start user.
+'''
+
+import argparse
+import os
+import sys
+import multiprocessing
+
+import cPickle as pickle
+import numpy as np
+import pandas as pd
+
+import train_model
+from build_hypergraph import file_digest, cache_key
+import shyrp
+
+# Shared, read-only data for the worker processes
+_DATA = dict()
+
+
+def process_arguments(args):
+    '''Process arguments from the command line'''
+
+    parser = argparse.ArgumentParser(description='SHYRP cross-validation')
+
+    parser.add_argument('-e', '--edge', dest='edge', default=False,
+                        action='store_true', help='Learn edge weights')
+    parser.add_argument('-b', '--bias', dest='bias', default=False,
+                        action='store_true', help='Learn song bias')
+    parser.add_argument('-u', '--user', dest='user', default=False,
+                        action='store_true', help='Learn user factors')
+    parser.add_argument('-s', '--song', dest='song', default=False,
+                        action='store_true', help='Learn song factors')
+    parser.add_argument('-d', '--num-factors', dest='num_factors', type=int,
+                        default=0, help='Number of latent factors')
+    parser.add_argument('-k', '--folds', dest='n_folds', type=int,
+                        default=5, help='Number of folds')
+    parser.add_argument('-j', '--num-jobs', dest='n_jobs', type=int,
+                        default=None,
+                        help='Number of folds to train in parallel')
+    parser.add_argument('-o', '--output', dest='output', required=True,
+                        type=str, help='Output path for fold results')
+    parser.add_argument('fold_path', type=str,
+                        help='Directory containing {k}_train.pickle '
+                        'and {k}_test.pickle')
+    parser.add_argument('edges', nargs='+',
+                        help='One or more edge files (dataframe pickles), '
+                        'or a single hypergraph built by build_hypergraph.py')
+
+    return vars(parser.parse_args(args))
+
+
+def fold_bigrams(fold_path, fold, songs, graph_key):
+    '''Decompose a fold into flat bigram arrays, using a cache if possible.
+
+    :returns:
+        - data : dict
+            - user_map : dict of training user => index
+            - train : (u_i, y_s, y_t) training bigrams
+            - test : (u_i, y_s, y_t) held-out bigrams, with unknown users
+              mapped to the cold-start index len(user_map)
+    '''
+
+    train_file = os.path.join(fold_path, '{:d}_train.pickle'.format(fold))
+    test_file = os.path.join(fold_path, '{:d}_test.pickle'.format(fold))
+
+    key = cache_key(graph_key, file_digest(train_file), file_digest(test_file))
+
+    cache_file = os.path.join(fold_path,
+                              '{:d}_bigrams-{:s}.pickle'.format(fold, key))
+
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as fdesc:
+            return pickle.load(fdesc)
+
+    print 'Decomposing fold {:d}'.format(fold)
+    pl_train = train_model.decompose(pd.read_pickle(train_file), songs)
+    pl_test = train_model.decompose(pd.read_pickle(test_file), songs)
+
+    user_map = dict([_[::-1] for _ in enumerate(pl_train.iterkeys())])
+
+    data = dict(user_map=user_map,
+                train=shyrp.make_theano_inputs(pl_train, user_map),
+                test=shyrp.make_theano_inputs(pl_test, user_map,
+                                              default_user=len(user_map)))
+
+    with open(cache_file, 'w') as fdesc:
+        pickle.dump(data, fdesc, protocol=-1)
+
+    return data
+
+
+def train_fold(fold):
+    '''Train and score a single fold (runs in a worker process)'''
+
+    H = _DATA['H']
+    data = _DATA['folds'][fold]
+    kwargs = _DATA['model_args']
+
+    # One extra row for cold-start users
+    model = shyrp.PlaylistModel(H, len(data['user_map']) + 1, **kwargs)
+    model.user_map_ = data['user_map']
+
+    model.fit_bigrams(*data['train'])
+
+    # The hypergraph is identified by the edge files, so it is not sent
+    # back (and saved) with every fold
+    params = model.serialize()
+    params.pop('H')
+    params['params'].pop('H')
+
+    return dict(fold=fold,
+                train_score=model.loglikelihood_bigrams(*data['train']),
+                test_score=model.loglikelihood_bigrams(*data['test']),
+                baseline=-np.log(H.shape[0]),
+                model=params)
+
+
+def run_cv(edge=False, bias=False, user=False, song=False, num_factors=0,
+           n_folds=5, n_jobs=None, output='', fold_path='', edges=None):
+
+    params = ''
+    if edge:
+        params += 'e'
+    if bias:
+        params += 'b'
+    if user:
+        params += 'u'
+    if song:
+        params += 's'
+
+    if params == '':
+        raise RuntimeError('At least one model parameter must be set: {EBUS}.')
+
+    print 'Loading edges'
+    H, songs = train_model.load_graph(*edges)
+
+    graph_key = cache_key(*[file_digest(_) for _ in edges])
+
+    _DATA['H'] = H
+    _DATA['folds'] = [fold_bigrams(fold_path, k, songs, graph_key)
+                      for k in range(n_folds)]
+    _DATA['model_args'] = dict(edge_reg=train_model.EDGE_REG,
+                               bias_reg=train_model.BIAS_REG,
+                               n_factors=num_factors,
+                               n_epochs=train_model.NUM_EPOCHS,
+                               batch_size=train_model.BATCH_SIZE,
+                               params=params,
+                               verbose=train_model.VERBOSE)
+
+    # Fork after the data is in place, so workers inherit it
+    print 'Training {:d} folds'.format(n_folds)
+    pool = multiprocessing.Pool(processes=n_jobs)
+    try:
+        results = pool.map(train_fold, range(n_folds))
+    finally:
+        pool.close()
+        pool.join()
+
+    print '{:>5s} {:>10s} {:>10s} {:>10s}'.format('fold', 'train', 'test',
+                                                  'baseline')
+    for res in results:
+        print '{fold:5d} {train_score:10.4f} {test_score:10.4f} ' \
+              '{baseline:10.4f}'.format(**res)
+
+    print 'Saving to {:s}'.format(output)
+    with open(output, 'w') as fdesc:
+        pickle.dump({'folds': results,
+                     'args': sys.argv[1:]},
+                    fdesc, protocol=-1)
+
+
+if __name__ == '__main__':
+    run_cv(**process_arguments(sys.argv[1:]))
@@ -1,45 +1,189 @@
 #!/usr/bin/env python
 # CREATED:2014-09-12 12:08:18 by Brian McFee <brian.mcfee@nyu.edu>
-# extract the spotify track ids from SPUD.sqlite and save them to a json file on disk
-
+# extract the spotify track ids from SPUD.sqlite into a binary mapping table
+#
+# The table is a flat file of fixed-size records:
+#   (SPUD trackid, spotify id, MSD id, hypergraph row)
+# sorted by trackid, and readable with `load_table` (np.memmap).
+#
+# Rows are fetched in chunks, and only tracks newer than the last trackid
+# in the table are extracted, so repeated runs append incrementally in
+# constant memory.
+#
+# If a hypergraph is given, the row column is recomputed for every record
+# in the table (not only the new ones), so rows stay valid when the graph is
+# rebuilt.  Records are joined on MSD track id by default, through the
+# *_tracks.npy index saved by build_hypergraph.py.
 
 import argparse
+import os
 import sys
 
 import sqlite3
-import ujson as json
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from song_index import SongIndex, index_file, track_file
+
+RECORD = np.dtype([('trackid', '<i8'),
+                   ('spotifyid', 'S22'),
+                   ('msd_id', 'S18'),
+                   ('row', '<i4')])
+
+
+def load_table(outfile, mode='r'):
+    ''' memory-map a mapping table '''
+
+    if not os.path.exists(outfile) or os.path.getsize(outfile) < RECORD.itemsize:
+        return np.zeros(0, dtype=RECORD)
+
+    n_records = os.path.getsize(outfile) // RECORD.itemsize
+
+    return np.memmap(outfile, dtype=RECORD, mode=mode, shape=(n_records,))
+
+
+def last_trackid(outfile):
+    ''' find the last complete record in the table, dropping any partial write '''
+
+    if not os.path.exists(outfile):
+        return None
 
-def get_ids(sqlitefile):
-    ''' query the sqlite database for spotify ids '''
+    size = os.path.getsize(outfile)
+    complete = size - size % RECORD.itemsize
+
+    if complete != size:
+        with open(outfile, 'r+b') as f:
+            f.truncate(complete)
+
+    table = load_table(outfile)
+
+    if len(table) == 0:
+        return None
+
+    return int(table[-1]['trackid'])
+
+
+def get_ids(sqlitefile, msd_column='msdid', after=None, chunk_size=10000):
+    ''' query the sqlite database for spotify ids, in chunks
+
+    yields (trackid, spotifyid, msd_id) rows with trackid > after
+    '''
+
+    query = 'select trackid, spotifyid, {:s} from tracks'.format(msd_column)
+    params = ()
+
+    if after is not None:
+        query += ' WHERE trackid > ?'
+        params = (after,)
+
+    query += ' ORDER BY trackid ASC'
 
-    results = []
-    
     with sqlite3.connect(sqlitefile) as dbc:
         cur = dbc.cursor()
-        cur.execute('select spotifyid from tracks ORDER BY trackid ASC')
-        results = [res[0] for res in cur.fetchall()]
-    
-    return results
+        cur.execute(query, params)
+
+        while True:
+            results = cur.fetchmany(chunk_size)
+            if not results:
+                break
+            yield results
+
 
-def save_ids(results, outfile):
-    '''save results to disk'''
+def save_ids(chunks, outfile):
+    ''' append chunks of results to the mapping table, with rows unset (-1) '''
+
+    n_records = 0
+
+    with open(outfile, 'ab') as f:
+        for results in chunks:
+            records = np.zeros(len(results), dtype=RECORD)
+            records['trackid'] = [res[0] for res in results]
+            records['spotifyid'] = [res[1] or '' for res in results]
+            records['msd_id'] = [res[2] or '' for res in results]
+            records['row'] = -1
+
+            records.tofile(f)
+            f.flush()
+            n_records += len(records)
+
+    return n_records
+
+
+def update_rows(outfile, index, chunk_size=100000):
+    ''' recompute the hypergraph row of every record in the table, in place
+
+    returns the number of records with a known msd_id that did not match
+    '''
+
+    table = load_table(outfile, mode='r+')
+
+    n_unmatched = 0
+
+    for i in range(0, len(table), chunk_size):
+        chunk = table[i:i + chunk_size]
+        rows = index.rows(chunk['msd_id'], missing=-1)
+        chunk['row'] = rows
+        n_unmatched += np.sum((rows < 0) & (chunk['msd_id'] != ''))
+
+    if isinstance(table, np.memmap):
+        table.flush()
+
+    return int(n_unmatched)
 
-    with open(outfile, 'w') as f:
-        json.dump(results, f)
 
 def get_args(args):
-    
+
     parser = argparse.ArgumentParser(description='SPUD database spotify track id extractor')
 
+    parser.add_argument('-c', '--msd-column', dest='msd_column', default='msdid',
+                        help='Column of the tracks table holding MSD ids')
+
+    parser.add_argument('-g', '--graph', dest='graph', default=None,
+                        help='Hypergraph (from build_hypergraph.py) used to '
+                        'fill in the row column of every record')
+
+    parser.add_argument('-j', '--join', dest='join', default='track',
+                        choices=['track', 'song'],
+                        help='Whether the MSD column holds track ids (TR...) '
+                        'or song ids (SO...)')
+
+    parser.add_argument('-n', '--chunk-size', dest='chunk_size', type=int,
+                        default=10000, help='Rows to fetch at a time')
+
+    parser.add_argument('--full', dest='full', default=False, action='store_true',
+                        help='Rebuild the table from scratch')
+
     parser.add_argument('SPUD.sqlite', action='store', help='Path to SPUD.sqlite')
 
-    parser.add_argument('output.json', action='store', help='Path to store spotify ids as json')
+    parser.add_argument('output', action='store', help='Path to the mapping table')
 
     return vars(parser.parse_args(args))
 
+
 if __name__ == '__main__':
     args = get_args(sys.argv[1:])
 
-    results = get_ids(args['SPUD.sqlite'])
-    save_ids(results, args['output.json'])
+    if args['full'] and os.path.exists(args['output']):
+        os.remove(args['output'])
+
+    chunks = get_ids(args['SPUD.sqlite'],
+                     msd_column=args['msd_column'],
+                     after=last_trackid(args['output']),
+                     chunk_size=args['chunk_size'])
+
+    n_records = save_ids(chunks, args['output'])
+
+    print 'Added {:d} tracks to {:s}'.format(n_records, args['output'])
+
+    if args['graph'] is not None:
+        if args['join'] == 'track':
+            index = SongIndex.load(track_file(args['graph']))
+        else:
+            index = SongIndex.load(index_file(args['graph']))
+
+        n_total = len(load_table(args['output']))
+        n_unmatched = update_rows(args['output'], index)
 
+        print 'Updated rows of {:d} tracks; {:d} did not match the hypergraph'.format(n_total, n_unmatched)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+'''Batched evaluation of trained playlist models.
+
+Held-out bigrams are scored in chunks against the full song catalog.  Each
+chunk yields the log-likelihood and rank of the true next song, from which
+per-playlist and per-user log-likelihoods and ranking metrics (recall@k, MRR)
+are aggregated.
+'''
+
+import argparse
+import sys
+
+import cPickle as pickle
+import numpy as np
+import pandas as pd
+
+from joblib import Parallel, delayed
+
+import shyrp
+import train_model
+from song_index import SongIndex
+
+
+def process_arguments(args):
+    '''Process arguments from the command line'''
+
+    parser = argparse.ArgumentParser(description='SHYRP model evaluation')
+
+    parser.add_argument('-k', '--recall', dest='k', type=int, nargs='+',
+                        default=[1, 10, 100],
+                        help='Cutoffs for recall@k')
+    parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int,
+                        default=256,
+                        help='Number of bigrams to score at once')
+    parser.add_argument('-j', '--num-jobs', dest='n_jobs', type=int,
+                        default=1, help='Number of chunks to score in parallel')
+    parser.add_argument('-o', '--output', dest='output', type=str,
+                        default=None, help='Path to store detailed results')
+    parser.add_argument('model', type=str,
+                        help='Trained model pickle (from train_model.py)')
+    parser.add_argument('playlists', type=str,
+                        help='Held-out playlist data pickle')
+
+    return vars(parser.parse_args(args))
+
+
+def model_arrays(model):
+    '''Pull out the parameters of a model.
+
+    :parameters:
+        - model : shyrp.PlaylistModel, or dict
+            A model object, or its serialized form (`model.serialize()`)
+
+    :returns:
+        - arrays : dict
+            H (csr), w, b, U, V, user_map.
+            U has an extra row of zeros for unknown users, at index
+            `len(U) - 1`.
+    '''
+
+    if isinstance(model, dict):
+        arrays = dict(H=model['H'], w=model['w'], b=model['b'],
+                      U=model['U'], V=model['V'], user_map=model['user_map'])
+    else:
+        arrays = dict(H=model.H, w=model.w_, b=model.b_,
+                      U=model.U_, V=model.V_, user_map=model.user_map_)
+
+    arrays['H'] = arrays['H'].tocsr()
+    arrays['U'] = np.vstack([arrays['U'],
+                             np.zeros((1, arrays['U'].shape[1]),
+                                      dtype=arrays['U'].dtype)])
+
+    return arrays
+
+
+def transition_probs(H, w, b, U, V, u_i, y_s):
+    '''Compute the next-song distribution for a batch of bigram sources.
+
+    This matches the model's likelihood computation, so that
+    `log(P[i, y_t[i]])` is the log-likelihood of bigram i.
+
+    :parameters:
+        - H : scipy.sparse.csr_matrix, shape=(n_songs, n_edges)
+        - w, b, U, V : np.ndarray
+            Model parameters
+        - u_i, y_s : np.ndarray, shape=(n,)
+            User and previous song indices. y_s < 0 indicates the start of
+            a playlist.
+
+    :returns:
+        - P : np.ndarray, shape=(n, n_songs)
+            P[i, j] = Pr(next song = j | previous song = y_s[i], user = u_i[i])
+    '''
+
+    return marginalize(H, w, np.dot(U[u_i], V.T) + b, y_s)
+
+
+def marginalize(H, w, scores, y_s):
+    '''Compute the next-song distribution from precomputed song scores.
+
+    :parameters:
+        - H : scipy.sparse.csr_matrix, shape=(n_songs, n_edges)
+        - w : np.ndarray
+            Edge weights
+        - scores : np.ndarray, shape=(n, n_songs)
+            Song scores (b + U[u_i] . V) for each example.
+            Modified in place.
+        - y_s : np.ndarray, shape=(n,)
+            Previous song indices, or < 0 at the start of a playlist
+
+    :returns:
+        - P : np.ndarray, shape=(n, n_songs)
+    '''
+
+    # Song scores: n * n_songs
+    scores -= scores.max(axis=1, keepdims=True)
+    e_scores = np.exp(scores)
+
+    # Score mass in each edge: n * n_edges
+    edge_norms = H.T.dot(e_scores.T).T
+
+    # Edge feasibilities given the previous song: n * n_edges
+    feas = H[np.maximum(y_s, 0)].toarray()
+    feas[y_s < 0] = 1
+
+    # Edge selection probabilities
+    edge_given_prev = feas * w
+    edge_given_prev -= edge_given_prev.max(axis=1, keepdims=True)
+    edge_given_prev = np.exp(edge_given_prev)
+    edge_given_prev /= edge_given_prev.sum(axis=1, keepdims=True)
+
+    # Marginalize over edges
+    return e_scores * H.dot((edge_given_prev / (shyrp._EPS + edge_norms)).T).T
+
+
+def score_chunk(arrays, u_i, y_s, y_t):
+    '''Log-likelihood and rank of the true next song for a chunk of bigrams
+
+    Ranks start at 1; ties are broken in favor of the true song.
+    '''
+
+    P = transition_probs(arrays['H'], arrays['w'], arrays['b'],
+                         arrays['U'], arrays['V'], u_i, y_s)
+
+    p_true = P[np.arange(len(y_t)), y_t]
+
+    rank = 1 + (P > p_true[:, np.newaxis]).sum(axis=1)
+
+    return np.log(p_true), rank
+
+
+def evaluate(model, playlists, k=(1, 10, 100), chunk_size=256, n_jobs=1):
+    '''Evaluate a model on a collection of playlists.
+
+    :parameters:
+        - model : shyrp.PlaylistModel or dict (serialized model)
+
+        - playlists : dict (users => list of playlists)
+            Users not known to the model are scored with all-zero factors.
+
+        - k : list of int
+            Cutoffs for recall@k
+
+        - chunk_size : int > 0
+            Number of bigrams to score at once
+
+        - n_jobs : int
+            Number of chunks to score in parallel
+
+    :returns:
+        - results : dict
+            - bigram : pd.DataFrame of user, playlist, log-likelihood and
+              rank for each bigram
+            - playlist : pd.Series of mean log-likelihood per playlist
+            - user : pd.Series of mean log-likelihood per user
+            - summary : pd.Series of aggregate metrics
+    '''
+
+    arrays = model_arrays(model)
+
+    u_i, y_s, y_t, pl_i, pl_keys = shyrp.make_theano_inputs(playlists,
+                                                            arrays['user_map'],
+                                                            default_user=len(arrays['U']) - 1,
+                                                            return_playlists=True)
+
+    chunks = Parallel(n_jobs=n_jobs)(delayed(score_chunk)(arrays,
+                                                          u_i[i:i + chunk_size],
+                                                          y_s[i:i + chunk_size],
+                                                          y_t[i:i + chunk_size])
+                                     for i in range(0, len(u_i), chunk_size))
+
+    ll = np.concatenate([_[0] for _ in chunks])
+    rank = np.concatenate([_[1] for _ in chunks])
+
+    users = np.asarray([_[0] for _ in pl_keys], dtype=object)[pl_i]
+
+    bigrams = pd.DataFrame(dict(user=users,
+                                playlist=pl_i,
+                                loglikelihood=ll,
+                                rank=rank))
+
+    summary = pd.Series(dict(loglikelihood=ll.mean(),
+                             baseline=-np.log(arrays['H'].shape[0]),
+                             mrr=(1.0 / rank).mean(),
+                             mean_rank=rank.mean(),
+                             median_rank=np.median(rank)))
+
+    for cutoff in k:
+        summary['recall@{:d}'.format(cutoff)] = (rank <= cutoff).mean()
+
+    playlist_ll = bigrams.groupby('playlist')['loglikelihood'].mean()
+    playlist_ll.index = pd.MultiIndex.from_tuples([pl_keys[_]
+                                                   for _ in playlist_ll.index],
+                                                  names=['user', 'playlist'])
+
+    return dict(bigram=bigrams,
+                playlist=playlist_ll,
+                user=bigrams.groupby('user')['loglikelihood'].mean(),
+                summary=summary)
+
+
+def run_evaluation(model='', playlists='', output=None, **kwargs):
+
+    print 'Loading model'
+    with open(model, 'r') as fdesc:
+        data = pickle.load(fdesc)
+
+    print 'Loading playlists'
+    playlists = train_model.decompose(pd.read_pickle(playlists),
+                                      SongIndex(data['song_ids']))
+
+    print 'Evaluating'
+    results = evaluate(data['model'], playlists, **kwargs)
+
+    print results['summary']
+
+    if output is not None:
+        print 'Saving to {:s}'.format(output)
+        with open(output, 'w') as fdesc:
+            pickle.dump(results, fdesc, protocol=-1)
+
+
+if __name__ == '__main__':
+    run_evaluation(**process_arguments(sys.argv[1:]))
@@ -7,6 +7,7 @@ Use this on the output of encode_msd.py
 import sys
 import argparse
 import cPickle as pickle
+import numpy as np
 import pandas as pd
 
 
@@ -19,7 +20,10 @@ def get_args(args):
                         dest='output_file',
                         required=True,
                         type=str,
-                        help='Path to store pickle')
+                        help='Path to store pickle. If the path ends in '
+                        '.npy, histograms are stored as a dense array '
+                        'suitable for memory-mapping, and track ids are '
+                        'stored alongside in *_tracks.npy')
 
     parser.add_argument('input_files', type=str, nargs='+',
                         help='One or more input pickles')
@@ -36,6 +40,10 @@ def merge_encodings(output_file='', input_files=None):
         with open(inf, 'r') as fdesc:
             data.update(pickle.load(fdesc))
 
+    if output_file.endswith('.npy'):
+        save_histograms(data, output_file)
+        return
+
     print 'Building dataframe'
     data = pd.DataFrame.from_dict(data, orient='index', dtype='float32')
 
@@ -43,5 +51,29 @@ def merge_encodings(output_file='', input_files=None):
     data.to_pickle(output_file)
 
 
+def track_file(output_file):
+    '''Path to the track ids corresponding to a histogram array'''
+    return '{:s}_tracks.npy'.format(output_file[:-len('.npy')])
+
+
+def save_histograms(data, output_file):
+    '''Save a dict of track id => histogram as a dense array, sorted by id'''
+
+    tracks = np.asarray(sorted(data.keys()))
+
+    print 'Saving {:d} histograms to {:s}'.format(len(tracks), output_file)
+
+    X = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.float32,
+                                  shape=(len(tracks), len(data[tracks[0]])))
+
+    for i, track_id in enumerate(tracks):
+        X[i] = data[track_id]
+
+    X.flush()
+    del X
+
+    np.save(track_file(output_file), tracks)
+
+
 if __name__ == '__main__':
     merge_encodings(**get_args(sys.argv[1:]))
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+'''Precomputed song-to-song neighbour index.
+
+Under the user-independent (bias-only) part of the model, the next-song
+distribution from song s is
+
+    Pr(t | s) = exp(b_t) sum_e H[t, e] g_s[e] / N_e
+
+with g_s = softmax(H[s] * w) over all edges and N_e = sum_j H[j, e] exp(b_j),
+as in the model's likelihood (see `beam_search`).  This depends only on
+trained parameters, so the top successors of every song can be computed once
+and stored as a CSR table: row s holds the top-N successors of s, sorted by
+decreasing log-probability.
+
+Personalized queries rerank the candidates of a song by adding V[t] . U[u]
+to their log-probabilities.  This ignores the change in edge norms N_e induced
+by the user factors, so it approximates the personalized model's ranking
+over the candidate set.
+'''
+
+import argparse
+import sys
+
+import cPickle as pickle
+import numpy as np
+import scipy.sparse
+
+import evaluate
+import shyrp
+from beam_search import edge_transitions, row_ids
+from build_hypergraph import save_csr, load_csr
+
+
+def process_arguments(args):
+    '''Process arguments from the command line'''
+
+    parser = argparse.ArgumentParser(description='Build a song neighbour index')
+
+    parser.add_argument('-n', '--num-neighbors', dest='n_neighbors', type=int,
+                        default=100, help='Number of successors per song')
+    parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int,
+                        default=1024, help='Number of songs to process at once')
+    parser.add_argument('--keep-self', dest='exclude_self', default=True,
+                        action='store_false',
+                        help='Allow songs to be their own successors')
+    parser.add_argument('model', type=str,
+                        help='Trained model pickle (from train_model.py)')
+    parser.add_argument('output', type=str,
+                        help='Path to store the index (npz)')
+
+    return vars(parser.parse_args(args))
+
+
+def top_successors(H, w, b, n_neighbors=100, chunk_size=1024,
+                   exclude_self=True):
+    '''Compute the top successors of every song under the bias-only model.
+
+    :parameters:
+        - H : scipy.sparse.csr_matrix, shape=(n_songs, n_edges)
+        - w, b : np.ndarray
+            Edge weights and song biases
+
+        - n_neighbors : int > 0
+            Number of successors to keep per song
+
+        - chunk_size : int > 0
+            Number of source songs to process at once
+
+        - exclude_self : bool
+            If true, songs are not their own successors
+
+    :returns:
+        - table : scipy.sparse.csr_matrix, shape=(n_songs, n_songs)
+            Row s holds the log-probabilities of the successors of s.
+            Stored entries within each row are sorted by decreasing
+            log-probability.
+    '''
+
+    H = H.tocsr()
+    n_songs = H.shape[0]
+    n_keep = min(n_neighbors, n_songs)
+
+    expb = np.exp(b - b.max())
+    inv_norms = 1.0 / (shyrp._EPS + H.T.dot(expb))
+
+    # The all-edges term, shared by every source: exp(b) * H (1 / N)
+    base = expb * H.dot(inv_norms)
+
+    psi, a, Z = edge_transitions(H, w)
+
+    targets = H.T.tocsr()
+    targets.data *= expb[targets.indices]
+
+    indptr = [np.zeros(1, dtype=np.int64)]
+    indices = []
+    data = []
+
+    for start in range(0, n_songs, chunk_size):
+        sources = np.arange(start, min(start + chunk_size, n_songs))
+
+        # Correction on the edges of each source
+        A = psi[sources]
+        A.data *= inv_norms[A.indices]
+        C = A.dot(targets).tocsr()
+
+        P = np.outer(a[sources], base)
+        P[row_ids(C), C.indices] += C.data
+        P /= Z[sources, np.newaxis]
+
+        if exclude_self:
+            P[np.arange(len(sources)), sources] = 0.0
+
+        # Top n_neighbors per row, in decreasing order
+        cols = np.argpartition(-P, n_keep - 1, axis=1)[:, :n_keep]
+        rows = np.arange(len(sources))[:, np.newaxis]
+        cols = cols[rows, np.argsort(-P[rows, cols], axis=1)]
+        vals = P[rows, cols]
+
+        keep = vals > 0
+
+        indices.append(cols[keep].astype(np.int32))
+        data.append(np.log(vals[keep]).astype(np.float32))
+        indptr.append(indptr[-1][-1] + np.cumsum(keep.sum(axis=1)))
+
+    return scipy.sparse.csr_matrix((np.concatenate(data),
+                                    np.concatenate(indices),
+                                    np.concatenate(indptr)),
+                                   shape=(n_songs, n_songs))
+
+
+class NeighborIndex(object):
+    '''Song-to-song successor lookups, with optional personalization.
+
+    :parameters:
+        - table : scipy.sparse.csr_matrix
+            Successor table, as computed by `top_successors`
+
+        - V : np.ndarray or None
+            Song factors, for personalized reranking
+
+        - U : np.ndarray or None
+            User factors
+
+        - user_ids : np.ndarray or None
+            User keys, in the order of the rows of U
+    '''
+
+    def __init__(self, table, V=None, U=None, user_ids=None):
+
+        self.indptr = table.indptr
+        self.indices = table.indices
+        self.data = table.data
+        self.V = V
+        self.U = U
+
+        self.user_map = dict()
+        if user_ids is not None:
+            self.user_map = dict([_[::-1] for _ in enumerate(user_ids)])
+
+    @classmethod
+    def build(cls, model, **kwargs):
+        '''Build an index from a trained model.
+
+        Keyword arguments are passed through to `top_successors`.
+        '''
+
+        arrays = evaluate.model_arrays(model)
+
+        table = top_successors(arrays['H'], arrays['w'], arrays['b'], **kwargs)
+
+        # Drop the cold-start row added by model_arrays
+        U = arrays['U'][:-1]
+        user_ids = sorted(arrays['user_map'], key=arrays['user_map'].get)
+
+        return cls(table, V=arrays['V'], U=U, user_ids=user_ids)
+
+    def save(self, filename):
+        '''Save the index to an npz file'''
+
+        n_songs = len(self.indptr) - 1
+
+        kwargs = dict()
+        if self.V is not None:
+            kwargs['V'] = self.V
+            kwargs['U'] = self.U
+            kwargs['user_ids'] = np.asarray(sorted(self.user_map,
+                                                   key=self.user_map.get))
+
+        save_csr(filename,
+                 scipy.sparse.csr_matrix((self.data, self.indices,
+                                          self.indptr),
+                                         shape=(n_songs, n_songs)),
+                 **kwargs)
+
+    @classmethod
+    def load(cls, filename):
+        '''Load an index saved by `NeighborIndex.save`'''
+
+        table, extra = load_csr(filename)
+
+        return cls(table, **extra)
+
+    def query(self, song, user=None, k=10):
+        '''Top successors of a song.
+
+        :parameters:
+            - song : int
+                Song index
+
+            - user : key into the user map, or None
+                If provided and known, candidates are reranked by the
+                user's song scores
+
+            - k : int > 0
+                Number of successors to return
+
+        :returns:
+            - songs : np.ndarray, dtype=int32
+            - scores : np.ndarray
+                Log-probabilities under the bias-only model, plus V . U[user]
+                for personalized queries
+        '''
+
+        start, end = self.indptr[song], self.indptr[song + 1]
+
+        songs = self.indices[start:end]
+        scores = self.data[start:end]
+
+        if user is None or user not in self.user_map:
+            return songs[:k], scores[:k]
+
+        scores = scores + self.V[songs].dot(self.U[self.user_map[user]])
+
+        if k < len(scores):
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+
+        top = top[np.argsort(-scores[top])]
+
+        return songs[top], scores[top]
+
+
+def build_index(model='', output='', **kwargs):
+
+    print 'Loading model'
+    with open(model, 'r') as fdesc:
+        data = pickle.load(fdesc)
+
+    print 'Building index'
+    index = NeighborIndex.build(data['model'], **kwargs)
+
+    print 'Saving to {:s}'.format(output)
+    index.save(output)
+
+
+if __name__ == '__main__':
+    build_index(**process_arguments(sys.argv[1:]))
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+'''HTTP recommendation server with request micro-batching.
+
+Concurrent requests are queued and coalesced into micro-batches: a batch is
+scored as soon as it is full, or when the oldest request in it has waited for
+the latency window.  Each batch is scored with a single matrix product over
+the song factors and the hypergraph (see `serving.ServingModel`).
+
+Endpoints:
+
+    POST /next      {"user": ..., "playlist": [song ids], "k": 10}
+        The k most likely next songs, excluding songs already in the playlist
+
+    POST /continue  {"user": ..., "playlist": [song ids], "n": 20}
+        Extend the playlist by n songs, without repeats
+
+Songs with zero probability are never returned, so results may be shorter
+than requested.  k and n are limited by --max-songs.
+
+    GET /stats
+        Latency percentiles (ms) and batch-size histograms per endpoint
+
+Unknown users are scored with all-zero user factors.
+
+The model may be a train_model.py pickle, or a reduced-precision export from
+serving.py (.npz), which carries its own song ids.
+'''
+
+import argparse
+import collections
+import sys
+import threading
+import time
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+
+import cPickle as pickle
+import numpy as np
+import ujson as json
+
+from serving import ServingModel
+from song_index import SongIndex
+
+
+def process_arguments(args):
+    '''Process arguments from the command line'''
+
+    parser = argparse.ArgumentParser(description='SHYRP recommendation server')
+
+    parser.add_argument('-H', '--host', dest='host', type=str,
+                        default='localhost', help='Address to listen on')
+    parser.add_argument('-p', '--port', dest='port', type=int, default=8000,
+                        help='Port to listen on')
+    parser.add_argument('-b', '--max-batch', dest='max_batch', type=int,
+                        default=64, help='Maximum requests per batch')
+    parser.add_argument('-w', '--max-wait', dest='max_wait', type=float,
+                        default=5.0,
+                        help='Latency window for batching (milliseconds)')
+    parser.add_argument('-s', '--song-index', dest='song_index', type=str,
+                        default=None,
+                        help='Song index (.npy) to memory-map, instead of '
+                        'the song ids stored with the model')
+    parser.add_argument('-m', '--max-songs', dest='max_songs', type=int,
+                        default=100,
+                        help='Maximum songs per request (k or n)')
+    parser.add_argument('model', type=str,
+                        help='Trained model pickle (from train_model.py), '
+                        'or exported model (npz, from serving.py)')
+
+    return vars(parser.parse_args(args))
+
+
+class Stats(object):
+    '''Thread-safe latency and batch-size statistics'''
+
+    def __init__(self, history=10000):
+        self.lock = threading.Lock()
+        self.latency = collections.deque(maxlen=history)
+        self.batch_sizes = collections.Counter()
+
+    def add_latency(self, seconds):
+        with self.lock:
+            self.latency.append(seconds)
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batch_sizes[size] += 1
+
+    def summary(self):
+        with self.lock:
+            latency = 1e3 * np.asarray(self.latency)
+            batch_sizes = dict(self.batch_sizes)
+
+        if len(latency):
+            p50, p99 = [float(_) for _ in np.percentile(latency, [50, 99])]
+        else:
+            p50, p99 = None, None
+
+        return dict(requests=len(latency), p50=p50, p99=p99,
+                    batch_sizes=batch_sizes)
+
+
+class MicroBatcher(object):
+    '''Coalesce concurrent requests into batches for a scoring function.
+
+    :parameters:
+        - score : callable
+            Maps a list of parsed requests to a list of results
+
+        - parse : callable or None
+            Validates and converts a single request.  It is called in the
+            submitting thread, so an invalid request raises there, and is
+            never batched with others.
+
+        - max_batch : int > 0
+            Maximum number of requests per batch
+
+        - max_wait : float >= 0
+            Maximum time (seconds) to wait for a batch to fill up
+    '''
+
+    def __init__(self, score, parse=None, max_batch=64, max_wait=5e-3):
+
+        self.score = score
+        self.parse = parse
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.stats = Stats()
+        self.queue = Queue.Queue()
+
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def submit(self, request):
+        '''Submit a request, and block until its result is ready'''
+
+        start = time.time()
+
+        if self.parse is not None:
+            request = self.parse(request)
+
+        pending = dict(request=request, done=threading.Event())
+
+        self.queue.put(pending)
+        pending['done'].wait()
+
+        self.stats.add_latency(time.time() - start)
+
+        if 'error' in pending:
+            raise pending['error']
+
+        return pending['result']
+
+    def run(self):
+        '''Worker loop: collect and score batches'''
+
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+
+            self.stats.add_batch(len(batch))
+
+            try:
+                results = self.score([_['request'] for _ in batch])
+                for pending, result in zip(batch, results):
+                    pending['result'] = result
+            except Exception as exc:
+                for pending in batch:
+                    pending['error'] = exc
+
+            for pending in batch:
+                pending['done'].set()
+
+
+class Recommender(object):
+    '''Batched scoring of recommendation requests for a trained model.
+
+    Requests may ask for at most `max_songs` songs: each song of a
+    continuation is a scoring pass over the catalog, during which the
+    batch's worker is held.
+    '''
+
+    def __init__(self, model, songs, max_songs=100):
+
+        if not isinstance(model, ServingModel):
+            model = ServingModel.from_model(model, precision='float32')
+
+        self.model = model
+        self.songs = songs
+        self.max_songs = max_songs
+
+    def parse(self, request, key='k'):
+        '''Validate a request, and convert it into
+        (user index, song rows, number of songs)
+
+        `key` names the field holding the number of songs to return.
+        Invalid requests raise ValueError.
+        '''
+
+        if not isinstance(request, dict):
+            raise ValueError('Request must be a JSON object')
+
+        playlist = request.get('playlist', [])
+        if (not isinstance(playlist, list) or
+                not all([isinstance(_, basestring) for _ in playlist])):
+            raise ValueError('playlist must be a list of song ids')
+
+        try:
+            rows = self.songs.rows(playlist).tolist()
+        except KeyError as exc:
+            raise ValueError('Unknown song id: {}'.format(exc.args[0]))
+
+        try:
+            count = int(request.get(key, 10))
+        except (TypeError, ValueError):
+            raise ValueError('{:s} must be an integer'.format(key))
+
+        if count < 1:
+            raise ValueError('{:s} must be positive'.format(key))
+
+        if count > self.max_songs:
+            raise ValueError('{:s} must be at most {:d}'.format(key,
+                                                                self.max_songs))
+
+        try:
+            user = self.model.user_index(request.get('user'))
+        except TypeError:
+            raise ValueError('user must be a string or number')
+
+        return user, rows, count
+
+    def parse_next(self, request):
+        return self.parse(request, key='k')
+
+    def parse_continue(self, request):
+        return self.parse(request, key='n')
+
+    def step(self, users, histories):
+        '''Next-song distributions for a batch of partial playlists,
+        with songs already in each playlist excluded.'''
+
+        y_s = np.asarray([_[-1] if len(_) else -1 for _ in histories])
+
+        P = self.model.transition_probs(np.asarray(users), y_s)
+
+        for i, history in enumerate(histories):
+            P[i, history] = 0.0
+
+        return P
+
+    def next_songs(self, requests):
+        '''Top-k next songs for each (parsed) request'''
+
+        users, histories, counts = zip(*requests)
+
+        P = self.step(users, histories)
+
+        results = []
+        for i, k in enumerate(counts):
+            top = np.argsort(-P[i])[:k]
+            top = top[P[i, top] > 0]
+            results.append([dict(song=self.songs[j],
+                                 probability=float(P[i, j]))
+                            for j in top])
+
+        return results
+
+    def continuations(self, requests):
+        '''Greedily extend each (parsed) playlist by n songs'''
+
+        users, histories, n_songs = zip(*requests)
+        histories = [list(_) for _ in histories]
+
+        results = [[] for _ in requests]
+        exhausted = [False for _ in requests]
+
+        for step in range(max(n_songs)):
+            # Only advance the requests that need, and can have, more songs
+            active = [i for i, n in enumerate(n_songs)
+                      if n > step and not exhausted[i]]
+
+            if not active:
+                break
+
+            P = self.step([users[i] for i in active],
+                          [histories[i] for i in active])
+
+            for row, i in enumerate(active):
+                song = int(np.argmax(P[row]))
+                if P[row, song] <= 0:
+                    exhausted[i] = True
+                    continue
+                histories[i].append(song)
+                results[i].append(self.songs[song])
+
+        return results
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Route requests to the server's micro-batchers'''
+
+    def send_json(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.send_json(404, dict(error='Not found'))
+
+        stats = dict([(name, batcher.stats.summary())
+                      for name, batcher in self.server.batchers.items()])
+
+        self.send_json(200, stats)
+
+    def do_POST(self):
+        batcher = self.server.batchers.get(self.path.strip('/'))
+
+        if batcher is None:
+            return self.send_json(404, dict(error='Not found'))
+
+        try:
+            length = int(self.headers.getheader('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            result = batcher.submit(request)
+        except ValueError as exc:
+            return self.send_json(400, dict(error=str(exc)))
+        except Exception as exc:
+            return self.send_json(500, dict(error=str(exc)))
+
+        self.send_json(200, dict(result=result))
+
+    def log_message(self, *args):
+        # Per-request logging is too noisy under load
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Threaded HTTP server; one handler thread per connection'''
+
+    daemon_threads = True
+
+
+def make_server(model, songs, host='localhost', port=8000, max_batch=64,
+                max_wait=5.0, max_songs=100):
+    '''Construct a server for a trained model.
+
+    Use port=0 to pick any free port; the chosen address is available as
+    `server.server_address`.  Call `server.serve_forever()` to start
+    handling requests, and `server.shutdown()` to stop.
+
+    :parameters:
+        - model : serving.ServingModel, shyrp.PlaylistModel,
+          or dict (serialized model)
+        - songs : song_index.SongIndex
+        - max_wait : float
+            Latency window for batching, in milliseconds
+        - max_songs : int > 0
+            Maximum number of songs a request may ask for
+    '''
+
+    recommender = Recommender(model, songs, max_songs=max_songs)
+
+    server = Server((host, port), Handler)
+    server.batchers = {'next': MicroBatcher(recommender.next_songs,
+                                            parse=recommender.parse_next,
+                                            max_batch=max_batch,
+                                            max_wait=1e-3 * max_wait),
+                       'continue': MicroBatcher(recommender.continuations,
+                                                parse=recommender.parse_continue,
+                                                max_batch=max_batch,
+                                                max_wait=1e-3 * max_wait)}
+
+    return server
+
+
+def run_server(model='', song_index=None, **kwargs):
+
+    print 'Loading model'
+    if model.endswith('.npz'):
+        model = ServingModel.load(model)
+        song_ids = model.song_ids
+    else:
+        with open(model, 'r') as fdesc:
+            data = pickle.load(fdesc)
+        model, song_ids = data['model'], data['song_ids']
+
+    if song_index is not None:
+        songs = SongIndex.load(song_index)
+    elif song_ids is not None:
+        songs = SongIndex(song_ids)
+    else:
+        raise ValueError('Model has no song ids; use --song-index')
+
+    server = make_server(model, songs, **kwargs)
+
+    print 'Serving on {:s}:{:d}'.format(*server.server_address)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    run_server(**process_arguments(sys.argv[1:]))
@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+'''Compact, reduced-precision models for serving.
+
+A trained model is exported as a single npz file holding only what is needed
+to score and sample:
+
+    - the hypergraph as int32 CSR indptr and indices.  Binary hypergraphs
+      are stored as a pattern only, exposed to scipy as a CSR matrix whose
+      data is a broadcast constant; weighted memberships (e.g., from soft
+      audio edges) are kept in float16.  The column-major (CSC) pattern is
+      stored alongside, so that the members of an edge are a slice
+    - edge weights w and song biases b in float32
+    - song and user factors V, U in float32, float16, or int8 with one scale
+      per row (x ~= scale * q, scale = max|x| / 127)
+    - user ids and, optionally, song ids
+
+Factors are dequantized on the fly, in chunks of songs, so the full-precision
+factor matrices are never materialized.  Scoring is identical to
+`evaluate.transition_probs` up to the precision of the factors; the accuracy
+loss against the original model is reported by `compare`.
+'''
+
+import argparse
+import os
+import sys
+
+import cPickle as pickle
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import evaluate
+import shyrp
+import train_model
+from song_index import SongIndex
+
+PRECISIONS = ('float32', 'float16', 'int8')
+
+
+def process_arguments(args):
+    '''Process arguments from the command line'''
+
+    parser = argparse.ArgumentParser(description='Export a model for serving')
+
+    parser.add_argument('-p', '--precision', dest='precision', type=str,
+                        choices=PRECISIONS, default='int8',
+                        help='Storage precision of the song and user factors')
+    parser.add_argument('-t', '--test', dest='playlists', type=str,
+                        default=None,
+                        help='Held-out playlist data pickle, for measuring '
+                        'the accuracy loss of the export')
+    parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int,
+                        default=256,
+                        help='Number of bigrams to score at once')
+    parser.add_argument('model', type=str,
+                        help='Trained model pickle (from train_model.py)')
+    parser.add_argument('output', type=str,
+                        help='Path to store the exported model (npz)')
+
+    return vars(parser.parse_args(args))
+
+
+def quantize(X, precision='int8'):
+    '''Reduce the precision of a matrix, row by row.
+
+    :parameters:
+        - X : np.ndarray, shape=(n, d)
+        - precision : str
+            One of 'float32', 'float16', or 'int8'
+
+    :returns:
+        - Q : np.ndarray, shape=(n, d)
+            Values at the requested precision
+        - scale : np.ndarray, shape=(n,), or None
+            Per-row scales for int8; None otherwise
+    '''
+
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision: {}'.format(precision))
+
+    if precision != 'int8':
+        return X.astype(precision), None
+
+    scale = (np.abs(X).max(axis=1) / 127.0).astype(np.float32)
+
+    Q = X / np.where(scale > 0, scale, 1.0)[:, np.newaxis]
+
+    return np.clip(np.round(Q), -127, 127).astype(np.int8), scale
+
+
+def dequantize(Q, scale=None):
+    '''Inverse of `quantize`, as float32'''
+
+    X = Q.astype(np.float32)
+
+    if scale is not None:
+        X *= scale[:, np.newaxis]
+
+    return X
+
+
+def incidence_matrix(indptr, indices, shape, data=None):
+    '''A float32 CSR matrix from its (possibly pattern-only) components.
+
+    If `data` is None, the matrix is binary, and its data array is a
+    zero-stride view of a single 1.0, so it takes no memory beyond indptr
+    and indices.
+    '''
+
+    if data is None:
+        data = np.broadcast_to(np.float32(1.0), indices.shape)
+    else:
+        data = data.astype(np.float32)
+
+    return scipy.sparse.csr_matrix((data, indices, indptr),
+                                   shape=shape, copy=False)
+
+
+def transpose_pattern(indptr, indices, shape, data=None):
+    '''The column-major (CSC) pattern of a CSR hypergraph.
+
+    :returns:
+        - indptr_T, indices_T : np.ndarray, dtype=int32
+            For each edge, the range of its songs, and the songs, in order
+        - data_T : np.ndarray or None
+            `data`, permuted to match `indices_T`
+    '''
+
+    order = np.argsort(indices, kind='mergesort')
+
+    songs = np.repeat(np.arange(shape[0], dtype=np.int32), np.diff(indptr))
+
+    indptr_T = np.zeros(shape[1] + 1, dtype=np.int32)
+    indptr_T[1:] = np.cumsum(np.bincount(indices, minlength=shape[1]))
+
+    data_T = None
+    if data is not None:
+        data_T = data[order]
+
+    return indptr_T, songs[order], data_T
+
+
+class ServingModel(object):
+    '''A trained model with reduced-precision parameters.
+
+    :parameters:
+        - indptr, indices : np.ndarray, dtype=int32
+            Sparsity pattern of the hypergraph, in CSR format
+        - shape : tuple
+            (n_songs, n_edges)
+        - data : np.ndarray or None
+            Membership weights, for non-binary hypergraphs
+        - indptr_T, indices_T, data_T : np.ndarray or None
+            The same hypergraph in CSC format; see `transpose_pattern`.
+            Built from the CSR arrays if not given.
+        - w, b : np.ndarray
+            Edge weights and song biases
+        - V, U : np.ndarray
+            Song and user factors, as returned by `quantize`.
+            U has an extra row for unknown users, at index `len(U) - 1`.
+        - V_scale, U_scale : np.ndarray or None
+            Per-row scales for int8 factors
+        - user_ids : np.ndarray
+            User keys, in the order of the rows of U
+        - song_ids : np.ndarray or None
+            Song ids, in row order
+    '''
+
+    def __init__(self, indptr, indices, shape, w, b, V, U, data=None,
+                 V_scale=None, U_scale=None, user_ids=None, song_ids=None,
+                 indptr_T=None, indices_T=None, data_T=None):
+
+        self.indptr = indptr
+        self.indices = indices
+        self.shape = tuple(shape)
+        self.data = data
+
+        if indptr_T is None or indices_T is None:
+            indptr_T, indices_T, data_T = transpose_pattern(indptr, indices,
+                                                            self.shape,
+                                                            data=data)
+        self.indptr_T = indptr_T
+        self.indices_T = indices_T
+        self.data_T = data_T
+
+        self.w = w
+        self.b = b
+        self.V = V
+        self.U = U
+        self.V_scale = V_scale
+        self.U_scale = U_scale
+        self.song_ids = song_ids
+
+        if user_ids is None:
+            user_ids = []
+
+        self.user_ids = np.asarray(user_ids)
+        self.user_map = dict([_[::-1] for _ in enumerate(self.user_ids)])
+
+    @property
+    def H(self):
+        '''The hypergraph, as a float32 CSR matrix'''
+        return incidence_matrix(self.indptr, self.indices, self.shape,
+                                data=self.data)
+
+    @property
+    def precision(self):
+        if self.V_scale is not None:
+            return 'int8'
+        return self.V.dtype.name
+
+    @property
+    def nbytes(self):
+        '''Total size of the stored arrays'''
+
+        arrays = [self.indptr, self.indices, self.data,
+                  self.indptr_T, self.indices_T, self.data_T,
+                  self.w, self.b, self.V, self.U, self.V_scale, self.U_scale]
+
+        return sum([_.nbytes for _ in arrays if _ is not None])
+
+    @classmethod
+    def from_model(cls, model, precision='int8', song_ids=None):
+        '''Export a trained model.
+
+        :parameters:
+            - model : shyrp.PlaylistModel or dict (serialized model)
+            - precision : str
+                Storage precision of V and U; see `quantize`
+            - song_ids : array-like, optional
+                Song ids to store with the model
+        '''
+
+        arrays = evaluate.model_arrays(model)
+
+        H = arrays['H']
+        H.sort_indices()
+
+        data = None
+        if np.any(H.data != 1):
+            data = H.data.astype(np.float16)
+
+        V, V_scale = quantize(arrays['V'], precision)
+        U, U_scale = quantize(arrays['U'], precision)
+
+        user_ids = sorted(arrays['user_map'], key=arrays['user_map'].get)
+
+        if song_ids is not None:
+            song_ids = SongIndex(song_ids).ids
+
+        return cls(H.indptr.astype(np.int32),
+                   H.indices.astype(np.int32),
+                   H.shape,
+                   np.asarray(arrays['w'], dtype=np.float32),
+                   np.asarray(arrays['b'], dtype=np.float32),
+                   V, U, data=data,
+                   V_scale=V_scale, U_scale=U_scale,
+                   user_ids=user_ids, song_ids=song_ids)
+
+    def save(self, filename):
+        '''Save the model to an npz file'''
+
+        kwargs = dict()
+        for key in ('data', 'data_T', 'V_scale', 'U_scale', 'song_ids'):
+            if getattr(self, key) is not None:
+                kwargs[key] = getattr(self, key)
+
+        tmp_name = '{:s}.tmp'.format(filename)
+
+        with open(tmp_name, 'wb') as fdesc:
+            np.savez(fdesc,
+                     indptr=self.indptr,
+                     indices=self.indices,
+                     indptr_T=self.indptr_T,
+                     indices_T=self.indices_T,
+                     shape=np.asarray(self.shape),
+                     w=self.w,
+                     b=self.b,
+                     V=self.V,
+                     U=self.U,
+                     user_ids=self.user_ids,
+                     **kwargs)
+
+        os.rename(tmp_name, filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''Load a model saved by `ServingModel.save`'''
+
+        with np.load(filename) as data:
+            arrays = dict([(key, data[key]) for key in data.files])
+
+        return cls(**arrays)
+
+    def user_index(self, user_id):
+        '''Row of U for a user; unknown users map to the all-zeros row'''
+        return self.user_map.get(user_id, len(self.U) - 1)
+
+    def item_scores(self, u_i, chunk_size=65536):
+        '''Song scores b + U[u_i] . V, dequantizing V in chunks of songs
+
+        :returns:
+            - scores : np.ndarray, shape=(len(u_i), n_songs), dtype=float32
+        '''
+
+        u_i = np.asarray(u_i)
+
+        users = dequantize(self.U[u_i],
+                           None if self.U_scale is None else self.U_scale[u_i])
+
+        scores = np.empty((len(u_i), self.shape[0]), dtype=np.float32)
+
+        for start in range(0, self.shape[0], chunk_size):
+            end = start + chunk_size
+            V = dequantize(self.V[start:end],
+                           None if self.V_scale is None else self.V_scale[start:end])
+            scores[:, start:end] = np.dot(users, V.T)
+
+        scores += self.b
+
+        return scores
+
+    def transition_probs(self, u_i, y_s):
+        '''Next-song distributions; see `evaluate.transition_probs`'''
+
+        return evaluate.marginalize(self.H, self.w, self.item_scores(u_i), y_s)
+
+    def loglikelihood(self, playlists, chunk_size=256):
+        '''Log-likelihood of each bigram in a collection of playlists.
+
+        Users not known to the model are scored with all-zero factors.
+        '''
+
+        u_i, y_s, y_t = shyrp.make_theano_inputs(playlists, self.user_map,
+                                                 default_user=len(self.U) - 1)
+
+        ll = []
+        for i in range(0, len(u_i), chunk_size):
+            P = self.transition_probs(u_i[i:i + chunk_size],
+                                      y_s[i:i + chunk_size])
+            ll.append(np.log(P[np.arange(len(P)), y_t[i:i + chunk_size]]))
+
+        return np.concatenate(ll)
+
+    def memberships(self, positions):
+        '''Membership weights of stored entries'''
+
+        if self.data is None:
+            return np.ones(len(positions), dtype=np.float32)
+
+        return self.data[positions].astype(np.float32)
+
+    def edge_members(self, edge):
+        '''Songs contained in an edge, and their membership weights'''
+
+        start, end = self.indptr_T[edge], self.indptr_T[edge + 1]
+
+        if self.data_T is None:
+            weights = np.ones(end - start, dtype=np.float32)
+        else:
+            weights = self.data_T[start:end].astype(np.float32)
+
+        return self.indices_T[start:end], weights
+
+    def song_edges(self, song):
+        '''Edges containing a song, and their membership weights'''
+
+        positions = np.arange(self.indptr[song], self.indptr[song + 1])
+
+        return self.indices[positions], self.memberships(positions)
+
+    def sample(self, user_id=None, n_songs=10, song_init=None, edge_init=None):
+        '''Sample a playlist; see `shyrp.PlaylistModel.sample`
+
+        :returns:
+            - playlist : list
+                list of track numbers
+            - edges : list
+                list of edge selections corresponding to selected tracks
+        '''
+
+        u = self.user_index(user_id)
+        user = dequantize(self.U[[u]],
+                          None if self.U_scale is None else self.U_scale[[u]])[0]
+
+        expw = np.exp(self.w - self.w.max())
+
+        if edge_init is not None:
+            edge = edge_init
+        elif song_init is not None:
+            candidates, weights = self.song_edges(song_init)
+            edge = candidates[shyrp.categorical(weights * expw[candidates])]
+        else:
+            edge = shyrp.categorical(expw)
+
+        playlist = []
+        edges = []
+
+        for _ in range(n_songs):
+            # Pick a song from the current edge
+            members, weights = self.edge_members(edge)
+            V = dequantize(self.V[members],
+                           None if self.V_scale is None else self.V_scale[members])
+            scores = V.dot(user) + self.b[members]
+            song = members[shyrp.categorical(weights
+                                             * np.exp(scores - scores.max()))]
+
+            playlist.append(int(song))
+            edges.append(int(edge))
+
+            # Pick an edge from the current song
+            candidates, weights = self.song_edges(song)
+            edge = candidates[shyrp.categorical(weights * expw[candidates])]
+
+        return playlist, edges
+
+
+def model_nbytes(model):
+    '''Total size of the parameters of a trained model'''
+
+    arrays = evaluate.model_arrays(model)
+    H = arrays['H']
+
+    return (H.data.nbytes + H.indices.nbytes + H.indptr.nbytes
+            + sum([arrays[_].nbytes for _ in ('w', 'b', 'U', 'V')]))
+
+
+def compare(model, served, playlists, chunk_size=256, k=10):
+    '''Measure the accuracy loss of an exported model on held-out data.
+
+    :parameters:
+        - model : shyrp.PlaylistModel or dict (serialized model)
+        - served : ServingModel
+        - playlists : dict (users => list of playlists)
+        - chunk_size : int > 0
+            Number of bigrams to score at once
+        - k : int > 0
+            Cutoff for the top-k overlap
+
+    :returns:
+        - summary : pd.Series
+            - loglikelihood : mean log-likelihood of the original model
+            - loglikelihood_served : mean log-likelihood of the export
+            - abs_diff_ll : mean |difference| in bigram log-likelihood
+            - total_variation : mean total variation distance between the
+              next-song distributions
+            - overlap@k : mean fraction of shared top-k next songs
+    '''
+
+    arrays = evaluate.model_arrays(model)
+
+    u_i, y_s, y_t = shyrp.make_theano_inputs(playlists, arrays['user_map'],
+                                             default_user=len(arrays['U']) - 1)
+
+    ll, ll_served, tv, overlap = [], [], [], []
+
+    for i in range(0, len(u_i), chunk_size):
+        users, prev, target = (u_i[i:i + chunk_size], y_s[i:i + chunk_size],
+                               y_t[i:i + chunk_size])
+
+        P = evaluate.transition_probs(arrays['H'], arrays['w'], arrays['b'],
+                                      arrays['U'], arrays['V'], users, prev)
+        Q = served.transition_probs(users, prev)
+
+        rows = np.arange(len(target))
+        ll.append(np.log(P[rows, target]))
+        ll_served.append(np.log(Q[rows, target]))
+        tv.append(0.5 * np.abs(P - Q).sum(axis=1))
+
+        top_p = np.argsort(-P, axis=1)[:, :k]
+        top_q = np.argsort(-Q, axis=1)[:, :k]
+        overlap.extend([len(np.intersect1d(a, b)) / float(k)
+                        for a, b in zip(top_p, top_q)])
+
+    ll = np.concatenate(ll)
+    ll_served = np.concatenate(ll_served)
+
+    summary = pd.Series(dict(loglikelihood=ll.mean(),
+                             loglikelihood_served=ll_served.mean(),
+                             abs_diff_ll=np.abs(ll - ll_served).mean(),
+                             total_variation=np.concatenate(tv).mean()))
+    summary['overlap@{:d}'.format(k)] = np.mean(overlap)
+
+    return summary
+
+
+def export_model(model='', output='', precision='int8', playlists=None,
+                 chunk_size=256):
+
+    print 'Loading model'
+    with open(model, 'r') as fdesc:
+        data = pickle.load(fdesc)
+
+    print 'Exporting at {:s} precision'.format(precision)
+    served = ServingModel.from_model(data['model'], precision=precision,
+                                     song_ids=data['song_ids'])
+
+    original = model_nbytes(data['model'])
+
+    print 'Parameter size: {:.2f}MB, {:.1f}x smaller than the original'.format(
+        served.nbytes / 2.0**20, original / float(served.nbytes))
+
+    if playlists is not None:
+        print 'Measuring accuracy loss'
+        playlists = train_model.decompose(pd.read_pickle(playlists),
+                                          SongIndex(data['song_ids']))
+        print compare(data['model'], served, playlists, chunk_size=chunk_size)
+
+    print 'Saving to {:s}'.format(output)
+    served.save(output)
+
+
+if __name__ == '__main__':
+    export_model(**process_arguments(sys.argv[1:]))
@@ -4,20 +4,47 @@
 import numpy as np
 
 import logging
+import hashlib
+import inspect
+import os
+import sys
+from collections import OrderedDict
 
-import theano
-import theano.tensor as T
-import theano.sparse as ts
+import cPickle as pickle
 
-import lasagne
+import scipy.sparse
+
+# theano is only required for the theano backend
+try:
+    import theano
+    import theano.tensor as T
+    import theano.sparse as ts
+    import theano.sandbox.rng_mrg
+except ImportError:
+    theano = None
 
 from sklearn.base import BaseEstimator
 
+import shyrp_numpy
+
 # Prevent numerical underflow
 _EPS = 1e-8
 
 L = logging.getLogger(__name__)
 
+# Compiled functions, shared by all models in the process.
+# Keys are graph signatures (see PlaylistModel.signature)
+_FUNCTIONS = dict()
+
+
+def floatX():
+    '''The floating point type for model parameters'''
+
+    if theano is None:
+        return 'float32'
+
+    return theano.config.floatX
+
 
 class PlaylistModel(BaseEstimator):
     '''Personalized hypergraph random walk playlist model'''
@@ -29,7 +56,10 @@ class PlaylistModel(BaseEstimator):
                  user_init=None, song_init=None,
                  params='ebus', verbose=0,
                  dropout=0.0,
-                 callback=None):
+                 callback=None,
+                 cache_dir=None,
+                 memory_budget=None,
+                 backend='theano'):
         """Initialize a personalized playlist model
 
         :parameters:
@@ -58,7 +88,8 @@ class PlaylistModel(BaseEstimator):
             Number of optimization steps
 
          - batch_size: int > 0
-            Number of examples to use in each training batch
+            Number of examples to use in each training batch.
+            If `memory_budget` is set, this is an upper bound.
 
          - edge_init : ndarray shape=(n_features,) or None
             Initial value of edge weight vector
@@ -91,15 +122,38 @@ class PlaylistModel(BaseEstimator):
 
             Signature:
             callback(model_object)
+
+         - cache_dir : None or str
+            Where to store compiled functions on disk.
+            By default, a subdirectory of theano's compiledir is used.
+            Set to False to disable the on-disk cache.
+
+         - memory_budget : None or int > 0
+            Memory budget (in bytes) for training and scoring.
+            If provided, batch sizes are chosen to fit the budget
+            (see `init_batch_sizes`), and are halved whenever an
+            allocation fails.
+            If None, `batch_size` is used for both training and scoring.
+
+         - backend : str, one of 'theano' or 'numpy'
+            How to compute the objective and its gradients.
+            'numpy' does not require theano or any compilation.
         """
 
+        if backend not in ('theano', 'numpy'):
+            raise ValueError('Unknown backend: {:s}'.format(backend))
+
+        if backend == 'theano' and theano is None:
+            raise ImportError('theano is required for backend=\'theano\'')
+
         # If we don't learn latent factors,
         # set n_factors to 1 and pin the user variables to 0
         if 'u' not in params and 's' not in params:
             n_factors = 1
 
-        # Stash the hypergraph as CSR
-        self.H = H.tocsr().astype(theano.config.floatX)
+        # Stash the hypergraph as CSR.  A CSR input of the right type is
+        # kept as-is, so forked workers share it copy-on-write.
+        self.H = H.tocsr().astype(floatX(), copy=False)
 
         self.n_users = n_users
 
@@ -124,6 +178,9 @@ class PlaylistModel(BaseEstimator):
 
         self.verbose = verbose
         self.callback = callback
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self.backend = backend
 
         L.setLevel(self.verbose)
 
@@ -132,7 +189,13 @@ class PlaylistModel(BaseEstimator):
                             user_init,
                             song_init)
 
-        self.init_functions()
+        self.init_batch_sizes()
+
+        # Functions are compiled (or fetched from the cache) on first use
+        self._functions = dict()
+
+        # Transpose of H, shared by the NumPy functions, built on first use
+        self._HT = None
 
     def init_variables(self, edge_init, bias_init, user_init, song_init):
         '''Construct theano shared variables'''
@@ -140,7 +203,82 @@ class PlaylistModel(BaseEstimator):
         self.user_map_ = {}
 
         self.n_songs, self.n_edges = self.H.shape
-        dtype = theano.config.floatX
+        dtype = floatX()
+
+        values = self.initial_values(edge_init, bias_init, user_init, song_init)
+
+        self._w = self.make_shared(values['w'], name='w')
+        self._b = self.make_shared(values['b'], name='b')
+        self._U = self.make_shared(values['U'], name='U')
+        self._V = self.make_shared(values['V'], name='V')
+
+        # The hypergraph is never updated, so it need not be copied
+        self._H = self.make_shared(self.H, name='H', borrow=True)
+
+        # Regularization constants are shared, so that they can be changed
+        # without recompiling the model
+        self._edge_reg = self.make_shared(np.asarray(self.edge_reg, dtype=dtype),
+                                          name='edge_reg')
+        self._bias_reg = self.make_shared(np.asarray(self.bias_reg, dtype=dtype),
+                                          name='bias_reg')
+        self._user_reg = self.make_shared(np.asarray(self.user_reg, dtype=dtype),
+                                          name='user_reg')
+        self._song_reg = self.make_shared(np.asarray(self.song_reg, dtype=dtype),
+                                          name='song_reg')
+
+        # Optimizer state for each learned parameter
+        self._accumulators = OrderedDict()
+        for var in self.learned_variables():
+            self._accumulators[var.name] = self.make_shared(np.zeros_like(var.get_value()),
+                                                            name='accu_{:s}'.format(var.name))
+
+        if self.backend == 'theano':
+            self._rng = theano.sandbox.rng_mrg.MRG_RandomStreams()
+
+    def make_shared(self, value, name, borrow=False):
+        '''Construct a shared variable for the model's backend.
+
+        If `borrow` is true, the variable holds `value` itself rather than a
+        copy.
+        '''
+
+        if self.backend == 'numpy':
+            return shyrp_numpy.SharedArray(value, name=name, borrow=borrow)
+
+        if scipy.sparse.issparse(value):
+            return ts.shared(value, name=name, borrow=borrow)
+
+        return theano.shared(value, name=name, borrow=borrow)
+
+    def learned_variables(self):
+        '''The shared variables which are updated during training'''
+
+        variables = []
+        if 'e' in self.params:
+            variables.append(self._w)
+        if 'b' in self.params:
+            variables.append(self._b)
+        if 'u' in self.params:
+            variables.append(self._U)
+        if 's' in self.params:
+            variables.append(self._V)
+
+        return variables
+
+    def shared_variables(self):
+        '''All shared variables of the model, indexed by name'''
+
+        variables = [self._w, self._b, self._U, self._V, self._H,
+                     self._edge_reg, self._bias_reg, self._user_reg,
+                     self._song_reg]
+        variables.extend(self._accumulators.values())
+
+        return OrderedDict([(var.name, var) for var in variables])
+
+    def initial_values(self, edge_init, bias_init, user_init, song_init):
+        '''Construct initial values for the model parameters'''
+
+        dtype = floatX()
 
         # Initialize the edge weights
         if edge_init is None:
@@ -149,8 +287,6 @@ class PlaylistModel(BaseEstimator):
             assert len(edge_init) == self.n_edges
             edge_init = edge_init.astype(dtype)
 
-        self._w = theano.shared(edge_init, name='w')
-
         # Initialize the bias term
         if bias_init is None:
             bias_init = np.zeros(self.n_songs, dtype=dtype)
@@ -158,8 +294,6 @@ class PlaylistModel(BaseEstimator):
             assert len(bias_init) == self.n_songs
             bias_init = bias_init.astype(dtype)
 
-        self._b = theano.shared(bias_init, name='b')
-
         # Initialize the user factors
         if user_init is None:
             user_init = np.zeros((self.n_users, self.n_factors), dtype=dtype)
@@ -167,8 +301,6 @@ class PlaylistModel(BaseEstimator):
             assert np.allclose(user_init.shape, (self.n_users, self.n_factors))
             user_init = user_init.astype(dtype)
 
-        self._U = theano.shared(user_init, name='U')
-
         # Initialize the song factors
         if song_init is None:
             song_init = np.random.randn(self.n_songs,
@@ -177,9 +309,141 @@ class PlaylistModel(BaseEstimator):
             assert np.allclose(song_init.shape, (self.n_songs, self.n_factors))
             song_init = song_init.astype(dtype)
 
-        self._V = theano.shared(song_init, name='V')
+        return dict(w=edge_init, b=bias_init, U=user_init, V=song_init)
+
+    def reinitialize(self, edge_init=None, bias_init=None, user_init=None,
+                     song_init=None, **kwargs):
+        '''Reset the parameters and optimizer state in place.
+
+        The shared variables are kept, so this is cheaper than
+        constructing a new model.
+
+        :parameters:
+         - edge_init, bias_init, user_init, song_init :
+            Initial values, as in the constructor
+
+         - kwargs :
+            Additional parameters to update, eg, `edge_reg` or `n_epochs`.
+            The number of factors and the learned parameters (`params`)
+            are fixed at construction, and cannot be changed here.
+        '''
+
+        for key in ('params', 'n_factors'):
+            if key in kwargs and kwargs.pop(key) != getattr(self, key):
+                raise ValueError('{:s} cannot be changed without '
+                                 'recompiling'.format(key))
+
+        self.set_params(**kwargs)
+
+        dtype = floatX()
+
+        self._edge_reg.set_value(np.asarray(self.edge_reg, dtype=dtype))
+        self._bias_reg.set_value(np.asarray(self.bias_reg, dtype=dtype))
+        self._user_reg.set_value(np.asarray(self.user_reg, dtype=dtype))
+        self._song_reg.set_value(np.asarray(self.song_reg, dtype=dtype))
+
+        values = self.initial_values(edge_init, bias_init, user_init, song_init)
+
+        self._w.set_value(values['w'])
+        self._b.set_value(values['b'])
+        self._U.set_value(values['U'])
+        self._V.set_value(values['V'])
+
+        # Reset the optimizer's accumulators
+        for var in self._accumulators.values():
+            var.set_value(np.zeros_like(var.get_value()))
+
+        self.user_map_ = {}
+
+        self.init_batch_sizes()
+
+    def memory_estimate(self, kind):
+        '''Estimate the memory used by a compiled function.
+
+        The dense intermediates of each example (item scores, dropout mask,
+        edge feasibilities and normalizers) scale with n_songs and n_edges;
+        training keeps a gradient for each of them.
+
+        :parameters:
+            - kind : str, one of 'train' or 'loglikelihood'
+
+        :returns:
+            - fixed : int
+                Bytes used independently of the batch size: parameters,
+                hypergraph, and (for training) gradients and optimizer state
+
+            - per_example : int
+                Additional bytes used per example in a batch
+        '''
+
+        itemsize = np.dtype(floatX()).itemsize
+
+        fixed = sum([var.get_value(borrow=True).nbytes
+                     for var in (self._w, self._b, self._U, self._V)])
+        fixed += self.H.data.nbytes + self.H.indices.nbytes + self.H.indptr.nbytes
+
+        song_terms, edge_terms = 3, 5
+
+        if kind == 'train':
+            fixed += 2 * sum([var.get_value(borrow=True).nbytes
+                              for var in self.learned_variables()])
+
+            if self.dropout > 0:
+                song_terms += 2
+
+            song_terms *= 2
+            edge_terms *= 2
+
+        per_example = itemsize * (song_terms * self.n_songs
+                                  + edge_terms * self.n_edges
+                                  + 2 * self.n_factors)
+
+        return fixed, per_example
+
+    def init_batch_sizes(self):
+        '''Choose the training and scoring batch sizes.
+
+        Without a memory budget, both are `batch_size`.  Otherwise, each is
+        the largest batch whose estimated memory use (`memory_estimate`) fits
+        the budget; the training batch is further capped at `batch_size`,
+        since it also affects optimization.
+        '''
+
+        if self.memory_budget is None:
+            self.batch_size_train_ = self.batch_size
+            self.batch_size_score_ = self.batch_size
+            return
+
+        sizes = dict()
+        for kind in ('train', 'loglikelihood'):
+            fixed, per_example = self.memory_estimate(kind)
+
+            sizes[kind] = int(self.memory_budget - fixed) // per_example
+
+            if sizes[kind] < 1:
+                raise ValueError('memory_budget={:d} is too small for {:s}: '
+                                 'need at least {:d} bytes'.format(int(self.memory_budget),
+                                                                   kind,
+                                                                   fixed + per_example))
+
+        self.batch_size_train_ = min(self.batch_size, sizes['train'])
+        self.batch_size_score_ = sizes['loglikelihood']
+
+        L.debug('Batch sizes: train={:d}, score={:d}'.format(self.batch_size_train_,
+                                                             self.batch_size_score_))
+
+    def shrink_batch_size(self, attr):
+        '''Halve a batch size after a failed allocation'''
+
+        size = getattr(self, attr)
+
+        if size <= 1:
+            raise MemoryError('Out of memory with a batch size of 1')
 
-        self._rng = theano.sandbox.rng_mrg.MRG_RandomStreams()
+        setattr(self, attr, size // 2)
+
+        L.warning('Out of memory: reducing {:s} from {:d} to {:d}'.format(attr, size,
+                                                                          size // 2))
 
     def fit(self, playlists):
         '''fit the model.
@@ -198,6 +462,18 @@ class PlaylistModel(BaseEstimator):
 
         u_i, y_s, y_t = make_theano_inputs(playlists, self.user_map_)
 
+        self.fit_bigrams(u_i, y_s, y_t)
+
+    def fit_bigrams(self, u_i, y_s, y_t):
+        '''fit the model to pre-computed bigram arrays.
+
+        :parameters:
+          - u_i, y_s, y_t : np.ndarray, dtype=int32
+            User, source and target indices, as produced by
+            `make_theano_inputs`.
+            The user map (`user_map_`) is not modified.
+        '''
+
         # Training loop
         self.nll_ = []
         self.cost_ = []
@@ -210,12 +486,22 @@ class PlaylistModel(BaseEstimator):
 
             L.debug('Training epoch {:d}'.format(self.epochs_))
 
-            for i in range(0, len(idx), self.batch_size):
+            i = 0
+            while i < len(idx):
+                batch = idx[i:i+self.batch_size_train_]
+
+                try:
+                    b_ll, b_cost = self._train(u_i=u_i[batch],
+                                               y_s=y_s[batch],
+                                               y_t=y_t[batch],
+                                               p=self.dropout)
+                except MemoryError:
+                    # Updates are only applied on success, so retry
+                    self.shrink_batch_size('batch_size_train_')
+                    continue
+
+                i += len(batch)
 
-                b_ll, b_cost = self._train(u_i=u_i[idx[i:i+self.batch_size]],
-                                           y_s=y_s[idx[i:i+self.batch_size]],
-                                           y_t=y_t[idx[i:i+self.batch_size]],
-                                           p=self.dropout)
                 self.nll_.append(b_ll)
                 self.cost_.append(b_cost)
 
@@ -227,8 +513,140 @@ class PlaylistModel(BaseEstimator):
 
         L.info('Done.')
 
-    def init_functions(self):
-        '''Construct functions for the model'''
+    def signature(self, kind):
+        '''The graph signature of a compiled function.
+
+        Models with equal signatures can share compiled functions.
+
+        :parameters:
+            - kind : str, one of 'train' or 'loglikelihood'
+        '''
+
+        if kind == 'train':
+            return (kind, _SOURCE_HASH, theano.config.floatX,
+                    ''.join(sorted(self.params)), self.dropout > 0)
+
+        return (kind, _SOURCE_HASH, theano.config.floatX)
+
+    @property
+    def _train(self):
+        return self.get_function('train')
+
+    @property
+    def _loglikelihood(self):
+        return self.get_function('loglikelihood')
+
+    def fast_path(self, kind):
+        '''Whether a function can use the non-personalized fast path.
+
+        Models which learn neither user nor song factors (eg, params='eb')
+        score every song identically for every user, so the item scores and
+        edge normalizers are shared by all examples in a batch.  This holds
+        unless dropout is used in training, or user factors were provided
+        at initialization.
+        '''
+
+        if 'u' in self.params or 's' in self.params:
+            return False
+
+        if kind == 'train' and self.dropout > 0:
+            return False
+
+        return not np.any(self._U.get_value(borrow=True))
+
+    def get_function(self, kind):
+        '''Get a compiled function bound to this model's variables.
+
+        Functions are looked up by signature in the in-process cache,
+        then in the on-disk cache, and are compiled only if both miss.
+        The numpy backend, and the non-personalized fast path (for either
+        backend), need no compilation.
+        '''
+
+        fast = self.fast_path(kind)
+
+        if fast or self.backend == 'numpy':
+            key = (kind, fast)
+            if key not in self._functions:
+                if self._HT is None:
+                    self._HT = shyrp_numpy.SharedArray(self.H.T.tocsr(),
+                                                       name='HT', borrow=True)
+                variables = self.shared_variables()
+                variables['HT'] = self._HT
+                learned = [_.name for _ in self.learned_variables()]
+                self._functions[key] = shyrp_numpy.make_function(kind,
+                                                                 variables,
+                                                                 learned,
+                                                                 fast=fast)
+            return self._functions[key]
+
+        key = self.signature(kind)
+
+        if key not in self._functions:
+
+            if key not in _FUNCTIONS:
+                _FUNCTIONS[key] = self.load_function(key)
+
+            # Rebind the shared function to our own variables
+            self._functions[key] = BoundFunction(_FUNCTIONS[key],
+                                                 self.shared_variables())
+
+        return self._functions[key]
+
+    def load_function(self, key):
+        '''Load a compiled function from disk, or compile and save it'''
+
+        cache_dir = self.cache_dir
+        if cache_dir is None:
+            cache_dir = os.path.join(theano.config.compiledir, 'shyrp')
+
+        filename = None
+        if cache_dir:
+            digest = hashlib.sha1(repr(key)).hexdigest()
+            filename = os.path.join(cache_dir, '{:s}.pickle'.format(digest))
+
+        if filename and os.path.exists(filename):
+            L.debug('Loading compiled {:s} function'.format(key[0]))
+            try:
+                with open(filename, 'rb') as fdesc:
+                    return pickle.load(fdesc)
+            except Exception as exc:
+                L.warning('Could not load {:s}: {}'.format(filename, exc))
+
+        L.debug('Compiling {:s} function'.format(key[0]))
+
+        # Compile against placeholder variables, so that the cached function
+        # does not keep this model's parameters alive
+        placeholders = dict()
+        for name, var in self.shared_variables().items():
+            if isinstance(var.type, ts.SparseType):
+                placeholders[name] = ts.shared(self.H[:1, :1], name=name)
+            else:
+                placeholders[name] = theano.shared(np.zeros((1,) * var.ndim,
+                                                            dtype=var.dtype),
+                                                   name=name)
+
+        fn = self.build_function(key[0], placeholders)
+
+        if filename:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+
+            tmp_name = '{:s}.{:d}'.format(filename, os.getpid())
+            with open(tmp_name, 'wb') as fdesc:
+                pickle.dump(fn, fdesc, protocol=-1)
+            os.rename(tmp_name, filename)
+
+        return fn
+
+    def build_function(self, kind, var):
+        '''Construct and compile a function for the model
+
+        :parameters:
+            - kind : str, one of 'train' or 'loglikelihood'
+            - var : dict
+                Shared variables to build the graph on, indexed by name
+        '''
 
         # Construct the objective function
 
@@ -238,14 +656,14 @@ class PlaylistModel(BaseEstimator):
         dropout = T.fscalar(name='p')
 
         #   Intermediate variables: n_examples * n_songs
-        item_scores = T.dot(self._U[u_i], self._V.T) + self._b
+        item_scores = T.dot(var['U'][u_i], var['V'].T) + var['b']
 
         # subtract off the row-wise max for numerical stability
         item_scores = item_scores - item_scores.max(axis=1, keepdims=True)
 
         e_scores = T.exp(item_scores)
 
-        if T.gt(dropout, 0.0):
+        if kind == 'train' and self.dropout > 0:
             # Construct a random dropout mask
             retain_prob = 1.0 - dropout
             M = self._rng.binomial(e_scores.shape,
@@ -262,62 +680,58 @@ class PlaylistModel(BaseEstimator):
             e_scores = e_scores * M
 
         #   Edge feasibilities: n_examples * n_edges
-        prev_feas = sparse_slice_rows(self.H, y_s)
+        prev_feas = sparse_slice_rows(var['H'], y_s)
         #   Detect and reset initial-state transitions
-        prev_feas = theano.tensor.set_subtensor(prev_feas[y_s < 0, :], 1)
+        prev_feas = T.switch(T.lt(y_s, 0).dimshuffle(0, 'x'), 1, prev_feas)
 
         #   Raw edge probabilities: n_examples * n_edges
-        edge_given_prev = T.nnet.softmax(prev_feas * self._w)
+        edge_given_prev = T.nnet.softmax(prev_feas * var['w'])
 
         #   Compute edge normalization factors: n_examples * n_edges
         #     sum of score mass in each edge for each user
-        edge_norms = ts.dot(e_scores, self.H)
+        edge_norms = ts.dot(e_scores, var['H'])
 
         #   Slice the edge weights according to incoming feasibilities: n_examples
         next_weight = e_scores[T.arange(y_t.shape[0]), y_t]
 
         #   Marginalize: n_examples * n_edges
-        next_feas = sparse_slice_rows(self.H, y_t)
+        next_feas = sparse_slice_rows(var['H'], y_t)
 
         probs = next_weight * T.sum(next_feas * (edge_given_prev / (_EPS + edge_norms)),
-                                    axis=1,
-                                    keepdims=True)
+                                    axis=1)
 
         # Data likelihood term
         ll = T.log(probs)
+
+        if kind == 'loglikelihood':
+            return theano.function(inputs=[u_i, y_s, y_t,
+                                           theano.Param(dropout,
+                                                        default=0.0,
+                                                        name='p')],
+                                   outputs=[ll],
+                                   on_unused_input='ignore')
+
         avg_ll = ll.mean()
 
         # Priors
-        w_prior = -0.5 * self.edge_reg * (self._w**2).sum()
-        b_prior = -0.5 * self.bias_reg * (self._b**2).sum()
-        u_prior = -0.5 * self.user_reg * (self._U**2).sum()
-        v_prior = -0.5 * self.song_reg * (self._V**2).sum()
+        w_prior = -0.5 * var['edge_reg'] * (var['w']**2).sum()
+        b_prior = -0.5 * var['bias_reg'] * (var['b']**2).sum()
+        u_prior = -0.5 * var['user_reg'] * (var['U']**2).sum()
+        v_prior = -0.5 * var['song_reg'] * (var['V']**2).sum()
 
         # negative log-MAP objective
         cost = -1.0 * (avg_ll + u_prior + v_prior + b_prior + w_prior)
 
         # Construct the updates
-        variables = []
-        if 'e' in self.params:
-            variables.append(self._w)
-        if 'b' in self.params:
-            variables.append(self._b)
-        if 'u' in self.params:
-            variables.append(self._U)
-        if 's' in self.params:
-            variables.append(self._V)
+        variables = [var[_.name] for _ in self.learned_variables()]
+        accumulators = [var['accu_{:s}'.format(_.name)] for _ in variables]
 
-        updates = lasagne.updates.adagrad(cost, variables)
+        updates = adagrad(cost, variables, accumulators)
 
-        self._train = theano.function(inputs=[u_i, y_s, y_t, dropout],
-                                      outputs=[avg_ll, cost],
-                                      updates=updates)
-
-        self._loglikelihood = theano.function(inputs=[u_i, y_s, y_t,
-                                                      theano.Param(dropout,
-                                                                   default=0.0,
-                                                                   name='p')],
-                                              outputs=[ll])
+        return theano.function(inputs=[u_i, y_s, y_t, dropout],
+                               outputs=[avg_ll, cost],
+                               updates=updates,
+                               on_unused_input='ignore')
 
     @property
     def U_(self):
@@ -409,20 +823,39 @@ class PlaylistModel(BaseEstimator):
 
         return playlist, edges
 
-    def loglikelihood(self, playlists, avg=True):
-        '''Compute the average log-likelihood of a collection of playlists'''
+    def loglikelihood(self, playlists, avg=True, default_user=None):
+        '''Compute the average log-likelihood of a collection of playlists
+
+        If `default_user` is provided, users not in the user map are scored
+        with that user index instead.
+        '''
+
+        u_i, y_s, y_t = make_theano_inputs(playlists, user_map=self.user_map_,
+                                           default_user=default_user)
+
+        return self.loglikelihood_bigrams(u_i, y_s, y_t, avg=avg)
 
-        u_i, y_s, y_t = make_theano_inputs(playlists, user_map=self.user_map_)
+    def loglikelihood_bigrams(self, u_i, y_s, y_t, avg=True):
+        '''Compute the log-likelihood of pre-computed bigram arrays'''
 
         # Compute in batches
         n_examples = len(u_i)
 
         ll = []
 
-        for i in range(0, n_examples, self.batch_size):
-            bll = self._loglikelihood(u_i=u_i[i:i+self.batch_size],
-                                      y_s=y_s[i:i+self.batch_size],
-                                      y_t=y_t[i:i+self.batch_size])[0].ravel()
+        i = 0
+        while i < n_examples:
+            batch = slice(i, i + self.batch_size_score_)
+
+            try:
+                bll = self._loglikelihood(u_i=u_i[batch],
+                                          y_s=y_s[batch],
+                                          y_t=y_t[batch])[0].ravel()
+            except MemoryError:
+                self.shrink_batch_size('batch_size_score_')
+                continue
+
+            i += len(bll)
             ll.extend(list(bll))
 
         ll = np.asarray(ll)
@@ -454,31 +887,85 @@ class PlaylistModel(BaseEstimator):
                     H=self.H)
 
 
+class BoundFunction(object):
+    '''A compiled function, rebound to a model's shared variables.
+
+    Compiled functions are shared by all models with the same graph
+    signature.  On each call, the storage of the function's shared variables
+    is swapped for the model's own, so nothing is copied or recompiled.
+    '''
+
+    def __init__(self, function, variables):
+
+        self.function = function
+        self.pairs = []
+
+        for i in function.maker.inputs:
+            if (isinstance(i.variable, theano.compile.SharedVariable) and
+                    i.variable.name in variables):
+                self.pairs.append((i.value, variables[i.variable.name].container))
+
+    def __call__(self, *args, **kwargs):
+
+        saved = [template.storage[0] for template, _ in self.pairs]
+
+        for template, own in self.pairs:
+            template.storage[0] = own.storage[0]
+
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            # Collect any updated values, and release our references
+            for (template, own), value in zip(self.pairs, saved):
+                own.storage[0] = template.storage[0]
+                template.storage[0] = value
+
+
 # Static functions
-def make_theano_inputs(playlists, user_map):
+def make_theano_inputs(playlists, user_map, default_user=None,
+                       return_playlists=False):
     '''Given a dictionary on user -> list of playlists,
     and a dictionary of user -> user_id,
     Construct theano-friendly inputs.
+
+    Users missing from user_map are assigned `default_user`,
+    or raise a KeyError if it is None.
+
+    If `return_playlists` is True, two more values are returned:
+    the playlist number of each bigram, and a list of (user, i) keys
+    identifying each playlist.
     '''
 
     u_id = []
     y_s = []
     y_t = []
+    pl_id = []
+    pl_keys = []
 
     for user_key, pls in playlists.iteritems():
 
-        my_uid = user_map[user_key]
+        if default_user is None:
+            my_uid = user_map[user_key]
+        else:
+            my_uid = user_map.get(user_key, default_user)
 
-        for pl in pls:
+        for i, pl in enumerate(pls):
             prevs, nexts = playlist_to_bigrams(pl)
 
             u_id.extend([my_uid] * len(prevs))
             y_s.extend(prevs)
             y_t.extend(nexts)
+            pl_id.extend([len(pl_keys)] * len(prevs))
+            pl_keys.append((user_key, i))
+
+    inputs = (np.asarray(u_id, dtype=np.int32),
+              np.asarray(y_s, dtype=np.int32),
+              np.asarray(y_t, dtype=np.int32))
 
-    return (np.asarray(u_id, dtype=np.int32),
-            np.asarray(y_s, dtype=np.int32),
-            np.asarray(y_t, dtype=np.int32))
+    if return_playlists:
+        return inputs + (np.asarray(pl_id, dtype=np.int32), pl_keys)
+
+    return inputs
 
 
 def playlist_to_bigrams(playlist, default=-1):
@@ -514,6 +1001,22 @@ def to_one_hot(y, nb_class, dtype=None):
     return ret
 
 
+def adagrad(cost, variables, accumulators, learning_rate=1.0, epsilon=1e-6):
+    '''Adagrad updates, with explicitly provided accumulators'''
+
+    grads = theano.grad(cost, variables)
+
+    updates = OrderedDict()
+
+    for param, grad, accu in zip(variables, grads, accumulators):
+        accu_new = accu + grad ** 2
+        updates[accu] = accu_new
+        updates[param] = param - (learning_rate * grad /
+                                  T.sqrt(accu_new + epsilon))
+
+    return updates
+
+
 def sparse_slice_rows(H, idx):
     '''Returns a dense slice H[idx, :]'''
 
@@ -531,3 +1034,7 @@ def categorical(z, size=None, replace=True):
     assert np.all(z >= 0.0) and np.any(z > 0)
 
     return np.random.choice(len(z), size=size, p=z, replace=replace)
+
+
+# Cached functions are invalidated whenever this module changes
+_SOURCE_HASH = hashlib.sha1(inspect.getsource(sys.modules[__name__])).hexdigest()
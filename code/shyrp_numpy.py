@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+'''NumPy backend for shyrp.PlaylistModel.
+
+Forward and backward passes of the model's objective, with analytic
+gradients, so that models can be trained and scored without theano.
+
+For a batch of bigrams (u_i, s_i, t_i), with e_ij = exp(b_j + U_ui . V_j)
+(times the dropout mask during training), the model computes
+
+    N_ie = sum_j e_ij H_je                      (edge normalizers)
+    g_ie = softmax_e(F_ie w_e)                  (F_ie = H_se, or 1 if s_i < 0)
+    r_i  = sum_e H_te g_ie / (eps + N_ie)
+    ll_i = log e_it + log r_i
+
+and the gradients of ll_i are
+
+    d ll_i / d z_ij   = delta_jt - e_ij sum_e H_je q_ie
+    d ll_i / d w_e    = F_ie g_ie (a_ie - 1)
+
+where z_ij = b_j + U_ui . V_j, a_ie = H_te / (eps + N_ie) / r_i and
+q_ie = a_ie g_ie / (eps + N_ie).  Intermediates touching only the target's
+edges are kept sparse; dense (batch x songs) and (batch x edges) buffers are
+allocated once and reused across steps.
+'''
+
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse
+
+# Prevent numerical underflow (as in shyrp)
+_EPS = 1e-8
+
+
+class SharedArray(object):
+    '''A named array, with the value interface of a theano shared variable'''
+
+    def __init__(self, value, name=None, borrow=False):
+        self.name = name
+        self.set_value(value, borrow=borrow)
+
+    def get_value(self, borrow=False):
+        if borrow:
+            return self.value
+        return self.value.copy()
+
+    def set_value(self, value, borrow=False):
+        if borrow:
+            self.value = value
+        else:
+            self.value = value.copy()
+
+    @property
+    def ndim(self):
+        return self.value.ndim
+
+    @property
+    def dtype(self):
+        return self.value.dtype
+
+
+class Buffers(object):
+    '''Named work arrays, grown on demand and reused across calls'''
+
+    def __init__(self):
+        self.arrays = dict()
+
+    def get(self, name, shape, dtype):
+        '''A view of a buffer with the given shape (contents undefined)'''
+
+        buf = self.arrays.get(name)
+
+        if (buf is None or buf.dtype != dtype or buf.shape[1:] != shape[1:]
+                or buf.shape[0] < shape[0]):
+            buf = np.empty(shape, dtype=dtype)
+            self.arrays[name] = buf
+
+        return buf[:shape[0]]
+
+
+def row_ids(X):
+    '''Row index of each stored entry of a CSR matrix'''
+
+    return np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+
+
+class Function(object):
+    '''Forward pass of the model, bound to a model's variables.
+
+    :parameters:
+        - variables : dict
+            The model's variables, indexed by name (see
+            `PlaylistModel.shared_variables`).  It may also hold the
+            transpose of H as CSR, 'HT', so that functions can share it.
+    '''
+
+    def __init__(self, variables):
+
+        self.var = variables
+        self.buffers = Buffers()
+
+        self.H = variables['H'].get_value(borrow=True).tocsr()
+
+        if 'HT' in variables:
+            self.HT = variables['HT'].get_value(borrow=True)
+        else:
+            self.HT = self.H.T.tocsr()
+
+    def forward(self, u_i, y_s, y_t, p=0.0):
+        '''Compute the log-likelihood of each example.
+
+        Intermediates needed for the backward pass are stored in
+        `self.state`.
+        '''
+
+        w = self.var['w'].get_value(borrow=True)
+        b = self.var['b'].get_value(borrow=True)
+        U = self.var['U'].get_value(borrow=True)
+        V = self.var['V'].get_value(borrow=True)
+        H = self.H
+
+        n = len(u_i)
+        n_songs, n_edges = H.shape
+        dtype = V.dtype
+        examples = np.arange(n)
+
+        # Item scores: n * n_songs
+        e = self.buffers.get('e', (n, n_songs), dtype)
+        np.dot(U[u_i], V.T, out=e)
+        e += b
+        e -= e.max(axis=1, keepdims=True)
+        np.exp(e, out=e)
+
+        if p > 0:
+            # Dropout, with importance weights; targets are always kept
+            mask = self.buffers.get('mask', (n, n_songs), dtype)
+            mask[:] = np.random.rand(n, n_songs) < (1.0 - p)
+            mask /= (1.0 - p)
+            mask[examples, y_t] = 1.0
+            e *= mask
+
+        # Edge normalizers: n * n_edges
+        norms = self.buffers.get('norms', (n, n_edges), dtype)
+        norms[:] = self.HT.dot(e.T).T
+        norms += _EPS
+
+        # Edge selection probabilities: n * n_edges
+        start = y_s < 0
+        F = H[np.maximum(y_s, 0)]
+        F_rows = row_ids(F)
+        F_keep = ~start[F_rows]
+        F_rows, F_cols, F_data = F_rows[F_keep], F.indices[F_keep], F.data[F_keep]
+
+        g = self.buffers.get('g', (n, n_edges), dtype)
+        g[:] = 0.0
+        g[F_rows, F_cols] = F_data * w[F_cols]
+        g[start] = w
+        g -= g.max(axis=1, keepdims=True)
+        np.exp(g, out=g)
+        g /= g.sum(axis=1, keepdims=True)
+
+        # Marginalize over the target's edges
+        Ht = H[y_t]
+        t_rows = row_ids(Ht)
+        t_cols = Ht.indices
+        t_frac = Ht.data / norms[t_rows, t_cols]
+
+        r = np.bincount(t_rows, weights=g[t_rows, t_cols] * t_frac,
+                        minlength=n)
+
+        ll = np.log(e[examples, y_t]) + np.log(r)
+
+        self.state = dict(e=e, norms=norms, g=g, r=r, Ht=Ht,
+                          t_rows=t_rows, t_cols=t_cols, t_frac=t_frac,
+                          F_rows=F_rows, F_cols=F_cols, F_data=F_data,
+                          start=start)
+
+        return ll.astype(dtype)
+
+
+class LogLikelihood(Function):
+    '''Per-example log-likelihood; called like the theano function'''
+
+    def __call__(self, u_i=None, y_s=None, y_t=None, p=0.0):
+        return [self.forward(u_i, y_s, y_t)]
+
+
+class Train(Function):
+    '''One adagrad step on a batch; called like the theano function.
+
+    :parameters:
+        - variables : dict
+            The model's variables, indexed by name
+
+        - learned : list of str
+            Names of the variables to update ('w', 'b', 'U', 'V')
+
+        - learning_rate, epsilon : float
+            Adagrad parameters, as in `shyrp.adagrad`
+    '''
+
+    def __init__(self, variables, learned, learning_rate=1.0, epsilon=1e-6):
+
+        super(Train, self).__init__(variables)
+
+        self.learned = learned
+        self.learning_rate = learning_rate
+        self.epsilon = epsilon
+
+    def __call__(self, u_i=None, y_s=None, y_t=None, p=0.0):
+
+        ll = self.forward(u_i, y_s, y_t, p=p)
+        avg_ll = ll.mean()
+
+        grads = self.gradients(u_i, y_s, y_t)
+
+        values = dict([(name, self.var[name].get_value(borrow=True))
+                       for name in ('w', 'b', 'U', 'V')])
+
+        prior = 0.0
+        for name, reg in [('w', 'edge_reg'), ('b', 'bias_reg'),
+                          ('U', 'user_reg'), ('V', 'song_reg')]:
+            prior += -0.5 * self.var[reg].get_value(borrow=True) * (values[name]**2).sum()
+
+        cost = -1.0 * (avg_ll + prior)
+
+        # Adagrad updates.  All new values are computed before any are
+        # assigned, so that a failure part-way leaves the model unchanged.
+        updates = []
+        for name in self.learned:
+            grad = grads[name]
+            accu = self.var['accu_{:s}'.format(name)].get_value(borrow=True) + grad**2
+            value = values[name] - self.learning_rate * grad / np.sqrt(accu + self.epsilon)
+            updates.append((name, value, accu))
+
+        for name, value, accu in updates:
+            self.var['accu_{:s}'.format(name)].set_value(accu, borrow=True)
+            self.var[name].set_value(value, borrow=True)
+
+        dtype = values['w'].dtype
+
+        return [np.asarray(avg_ll, dtype=dtype), np.asarray(cost, dtype=dtype)]
+
+    def gradients(self, u_i, y_s, y_t):
+        '''Gradients of the cost with respect to w, b, U and V.
+
+        Must be called after `forward` on the same batch.
+        '''
+
+        st = self.state
+        n = len(u_i)
+        examples = np.arange(n)
+
+        w = self.var['w'].get_value(borrow=True)
+        b = self.var['b'].get_value(borrow=True)
+        U = self.var['U'].get_value(borrow=True)
+        V = self.var['V'].get_value(borrow=True)
+
+        e, g, r = st['e'], st['g'], st['r']
+        t_rows, t_cols = st['t_rows'], st['t_cols']
+
+        g_t = g[t_rows, t_cols]
+        a = st['t_frac'] / r[t_rows]
+        q = a * g_t / st['norms'][t_rows, t_cols]
+
+        # d ll / d z: n * n_songs, overwriting the scores
+        Q = scipy.sparse.csr_matrix((q, t_cols, st['Ht'].indptr),
+                                    shape=g.shape)
+        HQ = Q.dot(self.HT).tocoo()
+
+        dz = e
+        dz_sparse = -HQ.data * e[HQ.row, HQ.col]
+        dz[:] = 0.0
+        dz[HQ.row, HQ.col] = dz_sparse
+        dz[examples, y_t] += 1.0
+
+        # The cost averages over the batch, and is negated
+        dz *= -1.0 / n
+
+        grads = OrderedDict()
+
+        # Edge weights: d ll / d logit = g (a - 1)
+        dlogit = g
+        dlogit *= -1.0
+        dlogit[t_rows, t_cols] += g_t * a
+
+        dw = np.bincount(st['F_cols'],
+                         weights=st['F_data'] * dlogit[st['F_rows'], st['F_cols']],
+                         minlength=len(w))
+        dw += dlogit[st['start']].sum(axis=0)
+
+        grads['w'] = (-dw / n).astype(w.dtype)
+        grads['w'] += self.var['edge_reg'].get_value(borrow=True) * w
+
+        grads['b'] = dz.sum(axis=0)
+        grads['b'] += self.var['bias_reg'].get_value(borrow=True) * b
+
+        grads['U'] = self.var['user_reg'].get_value(borrow=True) * U
+        np.add.at(grads['U'], u_i, np.dot(dz, V))
+
+        grads['V'] = np.dot(dz.T, U[u_i])
+        grads['V'] += self.var['song_reg'].get_value(borrow=True) * V
+
+        return grads
+
+
+class FastFunction(Function):
+    '''Forward pass for non-personalized models (no dropout).
+
+    With all-zero user factors, the item scores x = exp(b) and the edge
+    normalizers c_e = 1 / (eps + N_e) are shared by all examples, so they are
+    computed once per call.  For an example with source s and target t,
+
+        g_ie = (1 + phi_ie) / Z_i,   phi_ie = exp(H_se w_e) - 1
+        Z_i  = n_edges + sum_e phi_ie
+        r_i  = [(H c)_t + sum_e H_te phi_ie c_e] / Z_i
+
+    (or r_i = (H (g0 * c))_t with g0 = softmax(w) at the start of a
+    playlist).  phi is supported on the edges of s, so apart from
+    products with H, the cost of a call depends only on the number of
+    edges of the batch's songs.
+    '''
+
+    def forward(self, u_i, y_s, y_t, p=0.0):
+
+        w = self.var['w'].get_value(borrow=True)
+        b = self.var['b'].get_value(borrow=True)
+        H = self.H
+
+        n_edges = H.shape[1]
+
+        x = np.exp(b - b.max())
+        c = 1.0 / (_EPS + self.HT.dot(x))
+
+        g0 = np.exp(w - w.max())
+        g0 /= g0.sum()
+
+        # Source edges, with start-of-playlist rows removed
+        start = y_s < 0
+        G = H[np.maximum(y_s, 0)]
+        G.data[start[row_ids(G)]] = 0.0
+        G.eliminate_zeros()
+
+        # G holds F exp(F w); Phi holds exp(F w) - 1
+        Phi = G.copy()
+        Phi.data = np.expm1(G.data * w[G.indices])
+        G.data *= Phi.data + 1.0
+
+        Z = n_edges + np.asarray(Phi.sum(axis=1)).ravel()
+
+        Ht = H[y_t]
+        K = Ht.multiply(Phi).tocsr()
+
+        r = np.where(start,
+                     H.dot(g0 * c)[y_t],
+                     (H.dot(c)[y_t] + K.dot(c)) / Z)
+
+        ll = np.log(x[y_t]) + np.log(r)
+
+        self.state = dict(x=x, c=c, g0=g0, start=start, G=G, Z=Z,
+                          Ht=Ht, K=K, r=r)
+
+        return ll.astype(b.dtype)
+
+
+class FastLogLikelihood(FastFunction, LogLikelihood):
+    '''Per-example log-likelihood for non-personalized models'''
+    pass
+
+
+class FastTrain(FastFunction, Train):
+    '''One adagrad step on a batch, for non-personalized models'''
+
+    def gradients(self, u_i, y_s, y_t):
+        '''Gradients of the cost with respect to w and b.
+
+        Must be called after `forward` on the same batch.
+        '''
+
+        st = self.state
+        n = len(y_t)
+
+        w = self.var['w'].get_value(borrow=True)
+        b = self.var['b'].get_value(borrow=True)
+
+        x, c, g0, start = st['x'], st['c'], st['g0'], st['start']
+        Ht, K, G, Z, r = st['Ht'], st['K'], st['G'], st['Z'], st['r']
+
+        # Per-example weights 1 / (Z r), and 1 / r at playlist starts
+        inv_zr = np.where(start, 0.0, 1.0 / (Z * r))
+        inv_r0 = np.where(start, 1.0 / r, 0.0)
+        inv_z = np.where(start, 0.0, 1.0 / Z)
+
+        # sum_i H_te g_ie / r_i, for each edge
+        h_sum = Ht.T.dot(inv_r0)
+        hg = Ht.T.dot(inv_zr) + K.T.dot(inv_zr) + g0 * h_sum
+
+        # d ll / d b, summed over the batch
+        db = np.bincount(y_t, minlength=len(b)) - x * self.H.dot(c**2 * hg)
+
+        # d ll / d w: sum_i F_ie g_ie (a_ie - 1), with a_ie = H_te c_e / r_i
+        dw = (c * Ht.multiply(G).T.dot(inv_zr) - G.T.dot(inv_z)
+              + g0 * (c * h_sum - start.sum()))
+
+        grads = OrderedDict()
+
+        grads['w'] = (-dw / n).astype(w.dtype)
+        grads['w'] += self.var['edge_reg'].get_value(borrow=True) * w
+
+        grads['b'] = (-db / n).astype(b.dtype)
+        grads['b'] += self.var['bias_reg'].get_value(borrow=True) * b
+
+        return grads
+
+
+def make_function(kind, variables, learned=None, fast=False):
+    '''Construct a NumPy function for the model
+
+    :parameters:
+        - kind : str, one of 'train' or 'loglikelihood'
+        - variables : dict
+            The model's variables, indexed by name
+        - learned : list of str
+            Names of the variables updated by training
+        - fast : bool
+            Use the non-personalized fast path.
+            Only valid if the user factors are all zero, and (for
+            training) there is no dropout.
+    '''
+
+    if kind == 'train':
+        if fast:
+            return FastTrain(variables, learned)
+        return Train(variables, learned)
+
+    if fast:
+        return FastLogLikelihood(variables)
+    return LogLikelihood(variables)
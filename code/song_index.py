@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''Interned song identifiers.
+
+Song ids are stored once, as a fixed-width byte-string array in row order,
+and looked up in both directions with vectorized operations:
+
+    index = SongIndex(song_ids)
+    rows = index.rows(['SOAAAAA12A8C13C1D5', ...])
+    ids = index[rows]
+
+When the ids are sorted (as for hypergraphs built by build_hypergraph.py),
+lookups are a single `searchsorted`; otherwise a sort order is computed once.
+The index is saved as a plain .npy file next to the hypergraph, so that it can
+be memory-mapped by any number of training or serving processes.  The MSD
+track id of each song is saved alongside it, for joining external tables
+keyed by track.
+'''
+
+import numpy as np
+
+
+def index_file(graph_file):
+    '''Path to the song index stored alongside a hypergraph'''
+    return '{:s}_songs.npy'.format(graph_file.rsplit('.', 1)[0])
+
+
+def track_file(graph_file):
+    '''Path to the track id index stored alongside a hypergraph'''
+    return '{:s}_tracks.npy'.format(graph_file.rsplit('.', 1)[0])
+
+
+class SongIndex(object):
+    '''Bidirectional mapping between song ids and row numbers.
+
+    :parameters:
+        - ids : array-like or dict
+            Song id for each row.  A dict of row number => id is also
+            accepted, for artifacts written by older versions of
+            train_model.py.
+    '''
+
+    def __init__(self, ids):
+
+        if isinstance(ids, dict):
+            ids = [ids[_] for _ in range(len(ids))]
+
+        ids = np.asarray(ids)
+
+        if ids.dtype.kind != 'S':
+            ids = ids.astype(np.string_)
+
+        self.ids = ids
+
+        self.order = None
+        if np.any(ids[1:] < ids[:-1]):
+            self.order = np.argsort(ids, kind='mergesort')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, rows):
+        '''Song id(s) for row number(s)'''
+        return self.ids[rows]
+
+    def __contains__(self, song_id):
+        return self.rows([song_id], missing=-1)[0] >= 0
+
+    def rows(self, song_ids, missing=None):
+        '''Row numbers for a collection of song ids.
+
+        :parameters:
+            - song_ids : array-like of str
+            - missing : int or None
+                Value to return for unknown ids.  If None, unknown ids
+                raise a KeyError.
+
+        :returns:
+            - rows : np.ndarray, dtype=int
+        '''
+
+        song_ids = np.asarray(song_ids)
+
+        if len(song_ids) == 0:
+            return np.zeros(0, dtype=int)
+
+        if song_ids.dtype.kind != 'S':
+            song_ids = song_ids.astype(np.string_)
+
+        pos = np.searchsorted(self.ids, song_ids, sorter=self.order)
+        pos = np.minimum(pos, len(self.ids) - 1)
+
+        if self.order is not None:
+            pos = self.order[pos]
+
+        found = self.ids[pos] == song_ids
+
+        if not found.all():
+            if missing is None:
+                raise KeyError(song_ids[~found][0])
+            pos = np.where(found, pos, missing)
+
+        return pos
+
+    def save(self, filename):
+        '''Save the index as an .npy file'''
+        np.save(filename, self.ids)
+
+    @classmethod
+    def load(cls, filename, mmap_mode='r'):
+        '''Load an index saved by `SongIndex.save`, memory-mapped by default'''
+        return cls(np.load(filename, mmap_mode=mmap_mode))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+'''Hyperparameter sweeps for SHYRP, with successive halving.
+
+The hypergraph and bigram arrays are loaded once in the parent process, and
+inherited copy-on-write by a pool of forked workers.  Each worker keeps one
+compiled model per graph signature (learned parameters and number of factors),
+and reuses it across all configurations that differ only in regularization,
+dropout or training length.
+
+Configurations are trained for a small number of epochs, and only the best
+1/eta of them are retrained (from scratch) with eta times as many epochs,
+until a single configuration remains.
+'''
+
+import argparse
+import itertools
+import multiprocessing
+import sys
+
+import cPickle as pickle
+import numpy as np
+
+import train_model
+import cross_validate
+from build_hypergraph import file_digest, cache_key
+import shyrp
+
+# Shared, read-only data for the worker processes
+_DATA = dict()
+
+# Per-worker cache of compiled models
+_MODELS = dict()
+
+
+def process_arguments(args):
+    '''Process arguments from the command line'''
+
+    parser = argparse.ArgumentParser(description='SHYRP hyperparameter sweep')
+
+    parser.add_argument('-p', '--params', dest='params', type=str, nargs='+',
+                        default=['eb'],
+                        help='Parameters to learn, eg "eb" or "ebus"')
+    parser.add_argument('-d', '--num-factors', dest='n_factors', type=int,
+                        nargs='+', default=[0], help='Number of latent factors')
+    parser.add_argument('--edge-reg', dest='edge_reg', type=float, nargs='+',
+                        default=[train_model.EDGE_REG],
+                        help='Edge weight regularization')
+    parser.add_argument('--bias-reg', dest='bias_reg', type=float, nargs='+',
+                        default=[train_model.BIAS_REG],
+                        help='Song bias regularization')
+    parser.add_argument('--user-reg', dest='user_reg', type=float, nargs='+',
+                        default=[1e-3], help='User factor regularization')
+    parser.add_argument('--song-reg', dest='song_reg', type=float, nargs='+',
+                        default=[1e-3], help='Song factor regularization')
+    parser.add_argument('--dropout', dest='dropout', type=float, nargs='+',
+                        default=[0.0], help='Dropout rate')
+    parser.add_argument('-r', '--min-epochs', dest='min_epochs', type=int,
+                        default=1, help='Epochs in the first round')
+    parser.add_argument('-R', '--max-epochs', dest='max_epochs', type=int,
+                        default=train_model.NUM_EPOCHS,
+                        help='Maximum number of epochs')
+    parser.add_argument('--eta', dest='eta', type=int, default=3,
+                        help='Keep the top 1/eta configurations each round')
+    parser.add_argument('-k', '--fold', dest='fold', type=int, default=0,
+                        help='Which fold to use for training and validation')
+    parser.add_argument('-j', '--num-jobs', dest='n_jobs', type=int,
+                        default=None, help='Number of worker processes')
+    parser.add_argument('-o', '--output', dest='output', required=True,
+                        type=str, help='Output path for sweep results')
+    parser.add_argument('fold_path', type=str,
+                        help='Directory containing {k}_train.pickle '
+                        'and {k}_test.pickle')
+    parser.add_argument('edges', nargs='+',
+                        help='One or more edge files (dataframe pickles), '
+                        'or a single hypergraph built by build_hypergraph.py')
+
+    return vars(parser.parse_args(args))
+
+
+def make_configs(params=None, n_factors=None, edge_reg=None, bias_reg=None,
+                 user_reg=None, song_reg=None, dropout=None):
+    '''Build the grid of model configurations'''
+
+    keys = ['params', 'n_factors', 'edge_reg', 'bias_reg', 'user_reg',
+            'song_reg', 'dropout']
+
+    configs = []
+    for values in itertools.product(params, n_factors, edge_reg, bias_reg,
+                                    user_reg, song_reg, dropout):
+        config = dict(zip(keys, values))
+
+        # Factors are only meaningful for personalized models
+        if 'u' not in config['params'] and 's' not in config['params']:
+            config['n_factors'] = 0
+
+        if config not in configs:
+            configs.append(config)
+
+    return configs
+
+
+def get_model(config):
+    '''Get a compiled model for this configuration from the worker cache'''
+
+    config = dict(config)
+    signature = (config.pop('params'), config.pop('n_factors'))
+
+    if signature not in _MODELS:
+        _MODELS[signature] = shyrp.PlaylistModel(_DATA['H'],
+                                                 len(_DATA['user_map']) + 1,
+                                                 params=signature[0],
+                                                 n_factors=signature[1],
+                                                 batch_size=train_model.BATCH_SIZE)
+
+    model = _MODELS[signature]
+    model.reinitialize(**config)
+    model.user_map_ = _DATA['user_map']
+
+    return model
+
+
+def train_config(args):
+    '''Train and score a single configuration (runs in a worker process)'''
+
+    index, config, n_epochs = args
+
+    model = get_model(config)
+    model.n_epochs = n_epochs
+
+    model.fit_bigrams(*_DATA['train'])
+
+    score = model.loglikelihood_bigrams(*_DATA['test'])
+
+    if not np.isfinite(score):
+        score = -np.inf
+
+    return index, score
+
+
+def successive_halving(pool, configs, min_epochs=1, max_epochs=10, eta=3):
+    '''Run successive halving over a list of configurations.
+
+    :returns:
+        - history : list of dicts
+            One entry per round, with the number of epochs and the
+            validation score of each surviving configuration.
+    '''
+
+    alive = list(range(len(configs)))
+    n_epochs = min_epochs
+
+    history = []
+
+    while True:
+        print 'Training {:d} configurations for {:d} epochs'.format(len(alive),
+                                                                   n_epochs)
+
+        scores = dict(pool.map(train_config,
+                               [(i, configs[i], n_epochs) for i in alive]))
+
+        history.append(dict(n_epochs=n_epochs, scores=scores))
+
+        alive = sorted(alive, key=lambda i: scores[i], reverse=True)
+
+        for i in alive:
+            print '\t{:10.4f}  {}'.format(scores[i], configs[i])
+
+        if len(alive) == 1 or n_epochs >= max_epochs:
+            break
+
+        alive = alive[:max(1, len(alive) // eta)]
+        n_epochs = min(max_epochs, n_epochs * eta)
+
+    return history
+
+
+def run_sweep(output='', fold_path='', fold=0, edges=None, n_jobs=None,
+              min_epochs=1, max_epochs=10, eta=3, **kwargs):
+
+    print 'Loading edges'
+    H, songs = train_model.load_graph(*edges)
+
+    graph_key = cache_key(*[file_digest(_) for _ in edges])
+
+    _DATA['H'] = H
+    _DATA.update(cross_validate.fold_bigrams(fold_path, fold, songs,
+                                             graph_key))
+
+    configs = make_configs(**kwargs)
+
+    # Fork after the data is in place, so workers inherit it
+    pool = multiprocessing.Pool(processes=n_jobs)
+    try:
+        history = successive_halving(pool, configs,
+                                     min_epochs=min_epochs,
+                                     max_epochs=max_epochs,
+                                     eta=eta)
+    finally:
+        pool.close()
+        pool.join()
+
+    best = max(history[-1]['scores'], key=history[-1]['scores'].get)
+    print 'Best configuration: {}'.format(configs[best])
+
+    print 'Saving to {:s}'.format(output)
+    with open(output, 'w') as fdesc:
+        pickle.dump({'configs': configs,
+                     'history': history,
+                     'best': configs[best],
+                     'baseline': -np.log(H.shape[0]),
+                     'args': sys.argv[1:]},
+                    fdesc, protocol=-1)
+
+
+if __name__ == '__main__':
+    run_sweep(**process_arguments(sys.argv[1:]))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+'''Consistency tests for the NumPy backend of shyrp.PlaylistModel.
+
+One training step and one scoring pass are run on a small random hypergraph
+with each implementation, from identical initial parameters, and the
+outputs and updated variables are compared.
+'''
+
+import unittest
+
+import numpy as np
+import scipy.sparse
+
+import shyrp
+
+VARIABLES = ['w', 'b', 'U', 'V', 'accu_w', 'accu_b', 'accu_U', 'accu_V']
+
+
+def make_data(n_songs=40, n_edges=10, n_users=3, seed=0):
+    '''A random binary hypergraph, with a uniform edge, and a batch of
+    bigrams including playlist starts'''
+
+    rng = np.random.RandomState(seed)
+
+    H = scipy.sparse.rand(n_songs, n_edges - 1, density=0.3,
+                          format='csr', random_state=rng)
+    H.data[:] = 1.0
+    H = scipy.sparse.hstack([np.ones((n_songs, 1)), H]).tocsr()
+
+    u_i = np.array([0, 1, 2, 1, 0, 2], dtype=np.int32)
+    y_s = np.array([-1, 3, 5, -1, 7, 2], dtype=np.int32)
+    y_t = np.array([3, 5, 9, 1, 2, 30], dtype=np.int32)
+
+    return H, n_users, (u_i, y_s, y_t), rng
+
+
+def make_models(H, n_users, rng, backends, n_factors=3, zero_users=False,
+                **kwargs):
+    '''Models with identical initial parameters.
+
+    If `zero_users` is true, user factors are initialized to zero, as
+    required by the non-personalized fast path.
+    '''
+
+    n_songs, n_edges = H.shape
+
+    inits = dict(edge_init=rng.randn(n_edges),
+                 bias_init=rng.randn(n_songs),
+                 user_init=rng.randn(n_users, n_factors),
+                 song_init=rng.randn(n_songs, n_factors))
+
+    if zero_users:
+        inits['user_init'][:] = 0.0
+
+    inits.update(kwargs)
+
+    return [shyrp.PlaylistModel(H, n_users, n_factors=n_factors,
+                                backend=backend, cache_dir=False, **inits)
+            for backend in backends]
+
+
+class ConsistencyTest(unittest.TestCase):
+
+    rtol = 1e-4
+
+    def assertVariablesClose(self, model_a, model_b):
+
+        var_a = model_a.shared_variables()
+        var_b = model_b.shared_variables()
+
+        for name in VARIABLES:
+            if name not in var_a:
+                continue
+            np.testing.assert_allclose(var_a[name].get_value(),
+                                       var_b[name].get_value(),
+                                       rtol=self.rtol, atol=self.rtol * 1e-2,
+                                       err_msg=name)
+
+    def assertStepsClose(self, model_a, model_b, batch):
+
+        u_i, y_s, y_t = batch
+
+        np.testing.assert_allclose(model_a._loglikelihood(u_i=u_i, y_s=y_s, y_t=y_t)[0],
+                                   model_b._loglikelihood(u_i=u_i, y_s=y_s, y_t=y_t)[0],
+                                   rtol=self.rtol)
+
+        np.testing.assert_allclose(model_a._train(u_i=u_i, y_s=y_s, y_t=y_t, p=0.0),
+                                   model_b._train(u_i=u_i, y_s=y_s, y_t=y_t, p=0.0),
+                                   rtol=self.rtol)
+
+        self.assertVariablesClose(model_a, model_b)
+
+
+@unittest.skipIf(shyrp.theano is None, 'theano is not installed')
+class TestTheanoGradients(ConsistencyTest):
+    '''The NumPy backend matches the theano backend'''
+
+    rtol = 1e-5
+
+    def setUp(self):
+        self.floatX = shyrp.theano.config.floatX
+        shyrp.theano.config.floatX = 'float64'
+
+    def tearDown(self):
+        shyrp.theano.config.floatX = self.floatX
+
+    def test_train(self):
+
+        H, n_users, batch, rng = make_data()
+
+        model_t, model_n = make_models(H, n_users, rng, ['theano', 'numpy'])
+
+        self.assertFalse(model_t.fast_path('train'))
+        self.assertStepsClose(model_t, model_n, batch)
+
+
+class TestFastPath(ConsistencyTest):
+    '''The non-personalized fast path matches the general NumPy functions'''
+
+    def check_params(self, params):
+
+        H, n_users, batch, rng = make_data()
+
+        model_f, model_n = make_models(H, n_users, rng, ['numpy', 'numpy'],
+                                       zero_users=True, params=params)
+
+        self.assertTrue(model_f.fast_path('train'))
+        self.assertTrue(isinstance(model_f._train,
+                                   shyrp.shyrp_numpy.FastTrain))
+
+        # Force the general path on the reference model
+        model_n.fast_path = lambda kind: False
+
+        self.assertFalse(isinstance(model_n._train,
+                                    shyrp.shyrp_numpy.FastTrain))
+        self.assertStepsClose(model_f, model_n, batch)
+
+    def test_edges(self):
+        self.check_params('e')
+
+    def test_biases(self):
+        self.check_params('b')
+
+    def test_edges_biases(self):
+        self.check_params('eb')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,8 +4,11 @@
 import fix_path
 
 import argparse
+import os
 import sys
 import shyrp
+import build_hypergraph
+from song_index import SongIndex, index_file
 import numpy as np
 import scipy.sparse
 import cPickle as pickle
@@ -14,8 +17,9 @@ import pandas as pd
 
 np.set_printoptions(precision=3)
 
-shyrp.theano.config.exception_verbosity = 'high'
-shyrp.theano.config.floatX = 'float32'
+if shyrp.theano is not None:
+    shyrp.theano.config.exception_verbosity = 'high'
+    shyrp.theano.config.floatX = 'float32'
 
 MIN_EDGE_SIZE = 318
 EDGE_REG = 1e-6
@@ -35,24 +39,26 @@ def decompose(df, song_map, max_users=np.inf):
     if max_users == -1:
         max_users = np.inf
 
+    # Look up all song ids at once
+    rows = pd.Series(song_map.rows(df['song_id'].values), index=df.index)
+
     for count, user in enumerate(df.index.levels[0].unique()):
         if count >= max_users:
             break
         # Add the user to the playlist collection
         playlists.setdefault(user, [])
         # Slice the frame
-        d_u = df.loc[user]
+        d_u = rows.loc[user]
         for mix_id in d_u.index.get_level_values(0).unique():
             d_mix = d_u.loc[mix_id]
             for segment_id in d_mix.index.get_level_values(0).unique():
-                playlists[user].append([song_map[_]
-                                        for _ in d_mix.loc[segment_id]['song_id']])
+                playlists[user].append(d_mix.loc[segment_id].tolist())
     return playlists
 
 
 def graph_to_song_map(H):
-    '''pull the song id to row number index'''   
-    return dict([_[::-1] for _ in enumerate(H.index)])
+    '''pull the song id to row number index'''
+    return SongIndex(H.index.values)
 
 
 def load_edges(*files, **kwargs):
@@ -73,9 +79,43 @@ def load_edges(*files, **kwargs):
     return H
 
 
+def load_graph(*files, **kwargs):
+    '''Load the hypergraph as a CSR matrix and a song index.
+
+    A single .npz file is treated as the output of build_hypergraph.py;
+    otherwise, the files are edge dataframe pickles (see `load_edges`).
+    If a song index file was saved alongside the hypergraph, it is
+    memory-mapped.
+
+    Edge pickles are pruned to edges of at least `min_size` songs (default
+    `MIN_EDGE_SIZE`).  A hypergraph's edges were pruned when it was built
+    (`build_hypergraph.py --min-size`), so it is only pruned again if
+    `min_size` is given explicitly.
+    '''
+
+    if len(files) == 1 and files[0].endswith('.npz'):
+        H, songs, _ = build_hypergraph.load_graph(files[0])
+
+        if 'min_size' in kwargs:
+            H = H[:, np.flatnonzero(H.getnnz(axis=0) >= kwargs['min_size'])]
+
+        if os.path.exists(index_file(files[0])):
+            return H, SongIndex.load(index_file(files[0]))
+
+        return H, SongIndex(songs)
+
+    H_frame = load_edges(*files, **kwargs)
+    H_frame = H_frame.to_sparse(fill_value=0.0)
+
+    H = scipy.sparse.csr_matrix(H_frame.values, dtype=np.float32)
+
+    return H, graph_to_song_map(H_frame)
+
+
 def run_experiment(edge=False, bias=False, user=False, song=False,
                    max_users=-1, playlists='', edges=None,
-                   output='', num_factors=0):
+                   output='', num_factors=0, memory_budget=None,
+                   backend='theano'):
 
     params = ''
     if edge:
@@ -90,24 +130,19 @@ def run_experiment(edge=False, bias=False, user=False, song=False,
     if params == '':
         raise RuntimeError('At least one model parameter must be set: {EBUS}.')
 
-    # Load the graph
+    # Load the graph, and pull out the song ids
     print 'Loading edges'
-    H_frame = load_edges(*edges)
-    H_frame = H_frame.to_sparse(fill_value=0.0)
-
-    # And make a sparse matrix for shyrp
-    print 'Building the graph'
-    H = scipy.sparse.csr_matrix(H_frame.values, dtype=np.float32)
-
-    # Pull out the song ids
-    songs = graph_to_song_map(H_frame)
-    song_ids = dict([_[::-1] for _ in songs.items()])
+    H, songs = load_graph(*edges)
 
     # Load the training data
     print 'Loading training data'
     pl_train = pd.read_pickle(playlists)
     playlists = decompose(pl_train, songs, max_users=max_users)
 
+    if memory_budget is not None:
+        # Megabytes to bytes
+        memory_budget = int(memory_budget * 2**20)
+
     print 'Building the model'
     model = shyrp.PlaylistModel(H, len(playlists),
                                 edge_reg=EDGE_REG,
@@ -116,7 +151,9 @@ def run_experiment(edge=False, bias=False, user=False, song=False,
                                 n_epochs=NUM_EPOCHS,
                                 batch_size=BATCH_SIZE,
                                 params=params,
-                                verbose=VERBOSE)
+                                verbose=VERBOSE,
+                                memory_budget=memory_budget,
+                                backend=backend)
 
     print 'Training'
     model.fit(playlists)
@@ -126,7 +163,7 @@ def run_experiment(edge=False, bias=False, user=False, song=False,
         pickle.dump({'model': model.serialize(),
                      'train_score': model.loglikelihood(playlists),
                      'baseline': -np.log(H.shape[0]),
-                     'song_ids': song_ids,
+                     'song_ids': np.array(songs.ids),
                      'args': sys.argv[1:]},
                     fdesc, protocol=-1)
 
@@ -149,10 +186,18 @@ def process_arguments(args):
                         default=-1, help='Maximum number of users to train on')
     parser.add_argument('-d', '--num-factors', dest='num_factors', type=int,
                         help='Number of latent factors')
+    parser.add_argument('-M', '--memory-budget', dest='memory_budget',
+                        type=float, default=None,
+                        help='Memory budget (MB) for training and scoring; '
+                        'batch sizes are chosen to fit')
+    parser.add_argument('--backend', dest='backend', type=str,
+                        choices=['theano', 'numpy'], default='theano',
+                        help='Backend for training and scoring')
     parser.add_argument('playlists', type=str,
                         help='Playlist data pickle')
     parser.add_argument('edges', nargs='+',
-                        help='One or more edge files (dataframe pickles)')
+                        help='One or more edge files (dataframe pickles), '
+                        'or a single hypergraph built by build_hypergraph.py')
 
     return vars(parser.parse_args(args))
 